@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import time
+_IMPORT_STARTED = time.perf_counter()
+import argparse
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+
+from using_selenium import WebNavigationAgent, RateLimiter, LOAD_PROFILES, create_model, startup_timings
+from run_tasks import BrowserPool
+
+IMPORT_S = time.perf_counter() - _IMPORT_STARTED
+
+class AgentDaemon:
+    """Keeps a Gemini client and a pool of launched browsers warm and runs tasks sent over a local socket.
+    Each line received is one JSON request: {"url", "task", "max_steps", "id"} runs a task and answers with its
+    TaskResult plus queue and time-to-first-step figures; {"op": "stats"} answers with the startup timings."""
+    def __init__(self, api_key: str, workers: int = 1, headless: bool = True, load_profile: str = "full",
+                 max_tasks_per_driver: int = 20, rate_limiter: Optional[RateLimiter] = None):
+        self.api_key = api_key
+        self.headless = headless
+        self.load_profile = load_profile
+        self.rate_limiter = rate_limiter or RateLimiter.shared()
+        self.pool = BrowserPool(size=workers, headless=headless, max_tasks_per_driver=max_tasks_per_driver,
+                                load_profile=load_profile)
+        self.model = None
+        self.startup: Dict = {"import_s": round(IMPORT_S, 3)}
+        self.tasks = 0
+        self.succeeded = 0
+        self.first_step_s: List[float] = []
+        self._started = time.perf_counter()
+
+    async def start(self):
+        """Launch the browsers and create the Gemini client side by side"""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+
+        async def launch_browsers():
+            await self.pool.start()
+            self.startup["browser_launch_s"] = round(time.perf_counter() - start, 3)
+
+        async def init_model():
+            self.model = await loop.run_in_executor(None, create_model, self.api_key)
+            self.startup["model_init_s"] = round(time.perf_counter() - start, 3)
+
+        launched = await asyncio.gather(launch_browsers(), init_model(), return_exceptions=True)
+        for error in launched:
+            if isinstance(error, BaseException):
+                # The pool quits its own browsers if one fails; this covers a failed Gemini client
+                await self.pool.close()
+                raise error
+        self.startup["ready_s"] = round(time.perf_counter() - _IMPORT_STARTED, 3)
+        self.startup.update(startup_timings())
+
+    async def run_task(self, request: Dict) -> Dict:
+        received = time.perf_counter()
+        reply = {"id": request.get("id"), "url": request["url"], "task": request["task"], "success": False,
+                 "steps": 0, "reason": None, "error": None}
+        try:
+            browser = await self.pool.acquire()
+        except RuntimeError as e:
+            reply["error"] = str(e)
+            return reply
+        reply["queue_s"] = round(time.perf_counter() - received, 3)
+        agent = None
+        try:
+            agent = await WebNavigationAgent.create(
+                self.api_key, headless=self.headless, driver=browser.driver, model=self.model,
+                load_profile=self.load_profile, rate_limiter=self.rate_limiter
+            )
+            task_start = time.perf_counter()
+            result = await agent.perform_task(request["url"], request["task"], request.get("max_steps", 10))
+            reply.update(result.to_dict())
+            if result.first_step_s is not None:
+                reply["time_to_first_step_s"] = round(task_start - received + result.first_step_s, 3)
+                self.first_step_s.append(reply["time_to_first_step_s"])
+        except Exception as e:
+            reply["error"] = str(e)
+        finally:
+            if agent is not None:
+                agent.close()
+            await self.pool.release(browser)
+
+        reply["wall_time_s"] = round(time.perf_counter() - received, 2)
+        self.tasks += 1
+        self.succeeded += bool(reply["success"])
+        return reply
+
+    def stats(self) -> Dict:
+        return {
+            "startup": self.startup,
+            "uptime_s": round(time.perf_counter() - self._started, 1),
+            "tasks": self.tasks,
+            "succeeded": self.succeeded,
+            "mean_time_to_first_step_s": round(sum(self.first_step_s) / len(self.first_step_s), 3) if self.first_step_s else None,
+            "browser_launches": self.pool.launches,
+            "browser_recycles": self.pool.recycles,
+            "browser_launch_failures": self.pool.launch_failures,
+            "rate_limiter": self.rate_limiter.metrics()
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer each request line in order; a connection can send any number of them"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        reply = {"error": "each request must be a JSON object"}
+                    elif request.get("op") == "stats":
+                        reply = self.stats()
+                    elif "url" in request and "task" in request:
+                        reply = await self.run_task(request)
+                    else:
+                        reply = {"error": "each request needs 'url' and 'task', or 'op': 'stats'"}
+                except ValueError as e:
+                    reply = {"error": f"invalid JSON: {e}"}
+                writer.write((json.dumps(reply) + "\n").encode('utf-8'))
+                await writer.drain()
+        except ConnectionError as e:
+            print(f"Client disconnected: {e}")
+        finally:
+            writer.close()
+
+    async def close(self):
+        await self.pool.close()
+
+async def main():
+    parser = argparse.ArgumentParser(description="Resident agent that keeps Gemini and Chrome warm and takes tasks "
+                                                 "as JSON lines on a local socket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="number of warm browsers / concurrent tasks")
+    parser.add_argument("--max-tasks-per-driver", type=int, default=20, help="relaunch a browser after this many tasks")
+    parser.add_argument("--show-browser", action="store_true", help="run Chrome with a visible window")
+    parser.add_argument("--load-profile", choices=sorted(LOAD_PROFILES), default="full", help="resources to block while pages load")
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        raise ValueError("GOOGLE_API_KEY not found in .env file")
+
+    daemon = AgentDaemon(api_key, workers=args.workers, headless=not args.show_browser, load_profile=args.load_profile,
+                         max_tasks_per_driver=args.max_tasks_per_driver)
+    await daemon.start()
+    server = await asyncio.start_server(daemon.handle, args.host, args.port)
+    print(f"Agent daemon listening on {args.host}:{args.port}")
+    print(f"Startup: {json.dumps(daemon.startup)}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await daemon.close()
+        print(f"\nDaemon stopped: {json.dumps(daemon.stats())}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
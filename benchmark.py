@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from using_selenium import WebNavigationAgent, Tracer
+
+DEFAULT_SIZES = [100, 1000, 5000, 20000, 50000]
+
+# Phases reported per run, mapped to the tracer spans that measure them
+PHASES = {
+    "extraction": ("extract_elements", "extract_elements_delta"),
+    "screenshot": ("screenshot",),
+    "action": ("execute_action",),
+    "readiness_wait": ("readiness_wait",),
+    "llm": ("llm_call",),
+    "step": ("step",),
+}
+
+def generate_page(elements: int, depth: int = 6, delay_ms: int = 300) -> str:
+    """A page with roughly `elements` interactive elements: a search form, a long list of links,
+    deeply nested component-like wrappers, a few open shadow roots and content loaded after delay_ms."""
+    inputs = max(1, elements // 50)
+    buttons = max(1, elements // 10)
+    nested = max(1, elements // 5)
+    links = max(1, elements - inputs - buttons - nested)
+
+    parts = ['<!DOCTYPE html><html><head><title>Benchmark fixture</title>',
+             '<style>.card{padding:4px;margin:2px;border:1px solid #ccc}.spin{animation:spin 1s 1}'
+             '@keyframes spin{from{transform:rotate(0)}to{transform:rotate(90deg)}}</style></head><body>']
+    parts.append('<form id="search-form" onsubmit="return false;">'
+                 '<input id="search" name="q" type="text" placeholder="Search products" aria-label="Search">'
+                 '<button id="search-button" type="submit">Search</button></form>')
+    for i in range(inputs - 1):
+        parts.append(f'<label for="field-{i}">Field {i}</label><input id="field-{i}" name="field-{i}" type="text">')
+    parts.append('<button id="load-more" onclick="loadMore()">Load more</button>')
+    for i in range(buttons - 1):
+        parts.append(f'<button class="btn btn-secondary" data-testid="button-{i}">Button {i}</button>')
+
+    parts.append('<ul id="results">')
+    for i in range(links):
+        parts.append(f'<li><a href="/item/{i}" title="Item {i}">Product {i}</a></li>')
+    parts.append('</ul>')
+
+    for i in range(nested):
+        wrapper_open = ''.join(f'<div class="card level-{level}">' for level in range(depth))
+        wrapper_close = '</div>' * depth
+        parts.append(f'{wrapper_open}<div role="button" tabindex="0" onclick="">Widget {i}</div>{wrapper_close}')
+
+    parts.append('<div id="shadow-hosts">' + ''.join(f'<x-card data-index="{i}"></x-card>' for i in range(10)) + '</div>')
+    parts.append('<div id="delayed"></div>')
+    parts.append(f"""<script>
+        customElements.define('x-card', class extends HTMLElement {{
+            connectedCallback() {{
+                var root = this.attachShadow({{mode: 'open'}});
+                root.innerHTML = '<div><button>Shadow ' + this.dataset.index + '</button><a href="#">Shadow link</a></div>';
+            }}
+        }});
+        function loadMore() {{
+            return fetch('/items?count=20&delay={delay_ms}').then(function (r) {{ return r.json(); }}).then(function (items) {{
+                var list = document.getElementById('results');
+                items.forEach(function (item) {{
+                    var li = document.createElement('li');
+                    li.innerHTML = '<a class="spin" href="/item/' + item + '">Loaded ' + item + '</a>';
+                    list.insertBefore(li, list.firstChild);
+                }});
+            }});
+        }}
+        setTimeout(function () {{
+            document.getElementById('delayed').innerHTML = '<button id="delayed-button">Delayed action</button>';
+        }}, {delay_ms});
+    </script>""")
+    parts.append('</body></html>')
+    return "\n".join(parts)
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+
+        if parsed.path == "/page":
+            body = generate_page(int(query.get("elements", 100)), int(query.get("depth", 6)), int(query.get("delay", 300)))
+            self._send(body.encode('utf-8'), "text/html")
+        elif parsed.path == "/items":
+            time.sleep(int(query.get("delay", 300)) / 1000)
+            count = int(query.get("count", 20))
+            self._send(json.dumps([f"extra-{i}" for i in range(count)]).encode('utf-8'), "application/json")
+        elif parsed.path.startswith("/item/"):
+            self._send(f"<html><head><title>{parsed.path}</title></head><body><h1>{parsed.path}</h1></body></html>".encode('utf-8'), "text/html")
+        else:
+            self.send_error(404)
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fixture_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class StubUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+class StubResponse:
+    def __init__(self, text: str, prompt_chars: int):
+        self.text = text
+        self.usage_metadata = StubUsage(prompt_chars // 4 + 1, len(text) // 4 + 1)
+
+class StubChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+class StubStream:
+    """Streamed stub reply: the latency is spread over the chunks like a model generating tokens"""
+    def __init__(self, text: str, prompt_chars: int, latency: float, chunk_chars: int = 32):
+        self.chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        self.latency = latency
+        self.usage_metadata = StubUsage(prompt_chars // 4 + 1, len(text) // 4 + 1)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            if self.latency:
+                await asyncio.sleep(self.latency / len(self.chunks))
+            yield StubChunk(chunk)
+
+class StubModel:
+    """Deterministic stand-in for genai.GenerativeModel that cycles through scripted actions"""
+    SCRIPT = [
+        {"next_action": "type", "target_element": '//*[@id="search"]', "input_text": "benchmark laptop"},
+        {"next_action": "click", "target_element": '//*[@id="load-more"]'},
+        {"next_action": "scroll", "scroll_direction": "down"},
+        {"next_action": "click", "target_element": '//*[@id="search-button"]'},
+        {"next_action": "wait", "wait_time": 1},
+    ]
+
+    def __init__(self, script: Optional[List[Dict]] = None, latency: float = 0.0):
+        self.script = script or self.SCRIPT
+        self.latency = latency
+        self.calls = 0
+
+    def _respond(self, contents) -> StubResponse:
+        action = dict(self.script[self.calls % len(self.script)])
+        self.calls += 1
+        action.setdefault("analysis", "Scripted benchmark step")
+        action.setdefault("reasoning", "Scripted")
+        action.setdefault("confidence", 10)
+        action.setdefault("alternative_actions", [])
+        prompt_chars = sum(len(part) for part in _text_parts(contents))
+        return StubResponse("```json\n" + json.dumps(action) + "\n```", prompt_chars)
+
+    def _respond_streamed(self, contents) -> StubStream:
+        """The same scripted action in the action/followup/notes layout of a schema-constrained reply"""
+        action = dict(self.script[self.calls % len(self.script)])
+        self.calls += 1
+        action.setdefault("confidence", 10)
+        followup = {"plan": [], "alternative_actions": action.pop("alternative_actions", [])}
+        notes = {
+            "task_progress": "Scripted benchmark step",
+            "reasoning": "Scripted. " * 20,
+            "analysis": action.pop("analysis", "Scripted benchmark step. " * 20)
+        }
+        text = json.dumps({"action": action, "followup": followup, "notes": notes})
+        prompt_chars = sum(len(part) for part in _text_parts(contents))
+        return StubStream(text, prompt_chars, self.latency)
+
+    def generate_content(self, contents, **kwargs) -> StubResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(contents)
+
+    async def generate_content_async(self, contents, **kwargs) -> StubResponse:
+        if kwargs.get("stream"):
+            return self._respond_streamed(contents)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(contents)
+
+def _text_parts(contents) -> List[str]:
+    texts = []
+    for item in contents:
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, dict) and "parts" in item:
+            texts.extend(_text_parts(item["parts"]))
+    return texts
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def phase_stats(tracer: Tracer, task_id: str) -> Dict:
+    stats = {}
+    for phase, span_names in PHASES.items():
+        durations = [span["duration_ms"] for span in tracer.spans if span["task"] == task_id and span["name"] in span_names]
+        if not durations:
+            continue
+        stats[phase] = {
+            "count": len(durations),
+            "mean_ms": round(statistics.mean(durations), 2),
+            "p50_ms": round(percentile(durations, 0.5), 2),
+            "p95_ms": round(percentile(durations, 0.95), 2),
+            "total_ms": round(sum(durations), 2)
+        }
+    return stats
+
+async def run_scenario(agent: WebNavigationAgent, base_url: str, elements: int, steps: int, extract_repeats: int) -> Dict:
+    url = f"{base_url}/page?elements={elements}"
+    agent.model.calls = 0
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = await agent.perform_task(url, f"Benchmark {elements} elements", max_steps=steps)
+    elapsed = time.perf_counter() - start
+    task_id = agent.tracer.task_id
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    extraction_ms = []
+    for _ in range(extract_repeats):
+        extract_start = time.perf_counter()
+        extracted = await agent._in_driver(agent.get_page_elements)
+        extraction_ms.append((time.perf_counter() - extract_start) * 1000)
+
+    browser_heap = await agent._in_driver(
+        agent.driver.execute_script, "return performance.memory ? performance.memory.usedJSHeapSize : null;"
+    )
+
+    return {
+        "elements": elements,
+        "transport": agent.transport,
+        "steps": result.steps,
+        "steps_requested": steps,
+        "reason": result.reason,
+        "elapsed_s": round(elapsed, 3),
+        "steps_per_second": round(result.steps / elapsed, 3) if elapsed else 0.0,
+        "phases": phase_stats(agent.tracer, task_id),
+        "extraction_repeat_ms": [round(value, 2) for value in extraction_ms],
+        "elements_extracted": len(extracted) if extract_repeats else None,
+        "python_peak_bytes": python_peak,
+        "process_max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "browser_js_heap_bytes": browser_heap,
+        "responses": agent.response_summary()
+    }
+
+def compare_with_baseline(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Phases whose p50 latency grew by more than threshold (fraction) against the baseline"""
+    regressions = []
+    baseline_runs = {(run.get("transport", "webdriver"), run["elements"]): run for run in baseline.get("runs", [])}
+    for run in results["runs"]:
+        previous = baseline_runs.get((run.get("transport", "webdriver"), run["elements"]))
+        if previous is None:
+            continue
+        for phase, stats in run["phases"].items():
+            old = previous.get("phases", {}).get(phase)
+            if not old or not old["p50_ms"]:
+                continue
+            change = (stats["p50_ms"] - old["p50_ms"]) / old["p50_ms"]
+            if change > threshold:
+                regressions.append(f"{run['elements']} elements, {phase}: p50 {old['p50_ms']} -> {stats['p50_ms']} ms (+{change:.0%})")
+        if previous.get("steps_per_second") and run["steps_per_second"] < previous["steps_per_second"] * (1 - threshold):
+            regressions.append(f"{run['elements']} elements: steps/s {previous['steps_per_second']} -> {run['steps_per_second']}")
+    return regressions
+
+def compare_transports(runs: List[Dict]) -> List[str]:
+    """Per-step p50 latency of each transport for every page size, relative to the first transport"""
+    lines = []
+    for elements in sorted({run["elements"] for run in runs}):
+        by_transport = {run["transport"]: run for run in runs if run["elements"] == elements}
+        reference = None
+        cells = []
+        for transport, run in by_transport.items():
+            step_ms = run["phases"].get("step", {}).get("p50_ms")
+            if step_ms is None:
+                continue
+            if reference is None:
+                reference = step_ms
+                cells.append(f"{transport} {step_ms} ms")
+            else:
+                cells.append(f"{transport} {step_ms} ms ({(step_ms - reference) / reference:+.0%})")
+        lines.append(f"{elements} elements: " + ", ".join(cells))
+    return lines
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of WebNavigationAgent against local fixture pages")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="element counts of the generated pages")
+    parser.add_argument("--steps", type=int, default=5, help="agent steps per page")
+    parser.add_argument("--extract-repeats", type=int, default=3, help="extra standalone extractions per page")
+    parser.add_argument("--extraction-mode", choices=["script", "xpath"], default="script")
+    parser.add_argument("--prompt-format", choices=["compact", "json"], default="compact")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--no-rank", action="store_true", help="extract candidates in selector order instead of by task relevance")
+    parser.add_argument("--modality", choices=["full", "adaptive"], default="full", help="screenshot policy of the agent")
+    parser.add_argument("--response-mode", choices=["text", "streamed"], default="text",
+                        help="parse the finished reply, or stream a schema-constrained one and act before it ends")
+    parser.add_argument("--transports", nargs="+", choices=["webdriver", "cdp"], default=["webdriver"],
+                        help="run every page size once per transport and compare per-step latency")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="seconds the stub model sleeps per call")
+    parser.add_argument("--show-browser", action="store_true")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before a phase counts as a regression")
+    args = parser.parse_args()
+
+    server = start_fixture_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"Serving fixtures at {base_url}")
+
+    config = {
+        "extraction_mode": args.extraction_mode,
+        "prompt_format": args.prompt_format,
+        "incremental": args.incremental,
+        "rank_elements": not args.no_rank,
+        "transports": args.transports,
+        "modality": args.modality,
+        "response_mode": args.response_mode,
+        "steps": args.steps,
+        "stub_latency": args.stub_latency
+    }
+
+    results = {"config": config, "created": time.time(), "runs": []}
+    try:
+        for transport in args.transports:
+            agent = await WebNavigationAgent.create(
+                "offline-benchmark",
+                headless=not args.show_browser,
+                extraction_mode=args.extraction_mode,
+                prompt_format=args.prompt_format,
+                incremental=args.incremental,
+                rank_elements=not args.no_rank,
+                max_repeats=0,
+                max_consecutive_failures=0,
+                transport=transport,
+                modality=args.modality,
+                response_mode=args.response_mode,
+                tracer=Tracer(enabled=True),
+                model=StubModel(latency=args.stub_latency)
+            )
+            try:
+                for elements in args.sizes:
+                    print(f"\n=== {elements} elements, {transport} ===")
+                    run = await run_scenario(agent, base_url, elements, args.steps, args.extract_repeats)
+                    results["runs"].append(run)
+                    print(f"{elements} elements: {run['steps_per_second']} steps/s, phases: {json.dumps(run['phases'])}")
+                    print(f"{elements} elements: responses {json.dumps(run['responses'])}")
+            finally:
+                agent.close()
+    finally:
+        server.shutdown()
+
+    if len(args.transports) > 1:
+        print("\nPer-step p50 latency by transport:")
+        for line in compare_transports(results["runs"]):
+            print(line)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"✗ {regression}")
+            sys.exit(1)
+        print("\n✓ No regressions against baseline")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
+import json
 import os
 import subprocess
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v', '.3gp'}
+MANIFEST_NAME = '.to_gif_manifest.json'
 
 def check_ffmpeg():
     try:
@@ -15,67 +21,133 @@ def check_ffmpeg():
         return False
 
 def convert_video_to_gif(input_path, output_path, fps=10, scale=1280):
+    # One decode: the scaled frames are split, one copy feeds palettegen and the other paletteuse
     try:
-        palette_path = input_path.with_suffix('.palette.png')
         print(f"Converting {input_path.name} to {output_path.name}...")
-        palette_cmd = [
-            'ffmpeg',
-            '-i', str(input_path),
-            '-vf', f'fps={fps},scale={scale}:-1:flags=lanczos,palettegen',
-            '-y',
-            str(palette_path)
-        ]
-        palette_result = subprocess.run(palette_cmd, capture_output=True, text=True)
-        if palette_result.returncode != 0:
-            print(f"✗ Failed to generate palette for {input_path.name}: {palette_result.stderr}")
-            return False
+        partial_path = output_path.with_name(output_path.stem + '.partial.gif')
         gif_cmd = [
             'ffmpeg',
             '-i', str(input_path),
-            '-i', str(palette_path),
-            '-lavfi', f'fps={fps},scale={scale}:-1:flags=lanczos[x];[x][1:v]paletteuse',
+            '-vf', f'fps={fps},scale={scale}:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse',
             '-y',
-            str(output_path)
+            str(partial_path)
         ]
         gif_result = subprocess.run(gif_cmd, capture_output=True, text=True)
-        if palette_path.exists():
-            palette_path.unlink()
         if gif_result.returncode == 0:
+            os.replace(partial_path, output_path)
             print(f"✓ Successfully converted {input_path.name}")
             return True
         else:
+            if partial_path.exists():
+                partial_path.unlink()
             print(f"✗ Failed to convert {input_path.name}: {gif_result.stderr}")
             return False
     except Exception as e:
         print(f"✗ Error converting {input_path.name}: {str(e)}")
         return False
 
+def source_fingerprint(path, use_hash=False):
+    stat = path.stat()
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if use_hash:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        fingerprint = {'size': stat.st_size, 'sha1': digest.hexdigest()}
+    return fingerprint
+
+def load_manifest(path):
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠ Ignoring unreadable manifest {path.name}: {e}")
+        return {}
+
+def save_manifest(path, manifest):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def convert_job(input_path, output_path, fps, scale):
+    start = time.perf_counter()
+    ok = convert_video_to_gif(input_path, output_path, fps, scale)
+    return ok, time.perf_counter() - start
+
 def main():
+    parser = argparse.ArgumentParser(description="Convert every video in a directory to a GIF")
+    parser.add_argument('directory', nargs='?', default='.', help="directory with the videos (default: current directory)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="parallel ffmpeg processes")
+    parser.add_argument('--fps', type=int, default=10)
+    parser.add_argument('--scale', type=int, default=1280, help="output width in pixels")
+    parser.add_argument('--hash', action='store_true', help="detect changed sources by content hash instead of size and mtime")
+    parser.add_argument('--force', action='store_true', help="convert every video even if its GIF is up to date")
+    args = parser.parse_args()
     if not check_ffmpeg():
         print("Error: ffmpeg is not installed or not found in PATH")
         sys.exit(1)
-    current_dir = Path.cwd()
+    current_dir = Path(args.directory).resolve()
     print(f"Processing videos in: {current_dir}")
-    video_files = [f for f in current_dir.iterdir() if f.is_file() and f.suffix.lower() in VIDEO_EXTENSIONS]
+    video_files = sorted(f for f in current_dir.iterdir() if f.is_file() and f.suffix.lower() in VIDEO_EXTENSIONS)
     if not video_files:
         print("No video files found in the current directory.")
         return
     print(f"Found {len(video_files)} video file(s)")
-    successful_conversions = 0
-    failed_conversions = 0
+    manifest_path = current_dir / MANIFEST_NAME
+    manifest = load_manifest(manifest_path)
+    settings = {'fps': args.fps, 'scale': args.scale}
+    pending = []
     for video_file in video_files:
         gif_file = video_file.with_suffix('.gif')
-        if gif_file.exists():
-            print(f"⚠ Skipping {video_file.name} - {gif_file.name} already exists")
-            continue
-        if convert_video_to_gif(video_file, gif_file):
-            successful_conversions += 1
-        else:
-            failed_conversions += 1
+        fingerprint = source_fingerprint(video_file, args.hash)
+        entry = {'source': fingerprint, 'settings': settings}
+        previous = manifest.get(video_file.name)
+        if not args.force and gif_file.exists():
+            if previous is None:
+                # GIFs made before the manifest existed are trusted once, as the old name-based check did
+                print(f"⚠ Skipping {video_file.name} - {gif_file.name} already exists")
+                manifest[video_file.name] = entry
+                continue
+            if previous == entry:
+                print(f"⚠ Skipping {video_file.name} - {gif_file.name} is up to date")
+                continue
+        pending.append((video_file, gif_file, entry))
+    successful_conversions = 0
+    failed_conversions = 0
+    converted_bytes = 0
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            futures = {
+                executor.submit(convert_job, video_file, gif_file, args.fps, args.scale): (video_file, entry)
+                for video_file, gif_file, entry in pending
+            }
+            for future in as_completed(futures):
+                video_file, entry = futures[future]
+                ok, seconds = future.result()
+                if ok:
+                    successful_conversions += 1
+                    converted_bytes += entry['source']['size']
+                    manifest[video_file.name] = entry
+                    print(f"  {video_file.name}: {seconds:.1f} s")
+                else:
+                    failed_conversions += 1
+                    manifest.pop(video_file.name, None)
+    finally:
+        save_manifest(manifest_path, manifest)
+    elapsed = time.perf_counter() - start
     print(f"\nConversion complete!")
     print(f"✓ Successful: {successful_conversions}")
     if failed_conversions > 0:
         print(f"✗ Failed: {failed_conversions}")
+    if pending and elapsed > 0:
+        processed = successful_conversions + failed_conversions
+        print(f"Throughput: {processed / elapsed:.2f} files/s, {converted_bytes / 1024 / 1024 / elapsed:.2f} MB/s "
+              f"({args.workers} worker(s), {elapsed:.1f} s)")
 
 if __name__ == "__main__":
     main()
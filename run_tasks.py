@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+
+from using_selenium import (
+    WebNavigationAgent, DecisionCache, TrajectoryStore, RateLimiter, LOAD_PROFILES, create_model, launch_chrome,
+    needs_performance_log, reset_browser_state, resolve_load_profile
+)
+
+@dataclass
+class PooledBrowser:
+    driver: object
+    browser_id: int
+    tasks_run: int = 0
+
+class BrowserPool:
+    """Keeps warm Chrome instances and hands them out to tasks.
+    Drivers are reset between tasks and relaunched after max_tasks_per_driver tasks or a crash. A browser that
+    cannot be relaunched is dropped, and once none are left acquire() raises instead of waiting forever."""
+    def __init__(self, size: int = 2, headless: bool = True, max_tasks_per_driver: int = 20, load_profile: str = "full",
+                 launch_attempts: int = 2):
+        self.size = size
+        self.headless = headless
+        self.load_profile = resolve_load_profile(load_profile)
+        self.max_tasks_per_driver = max_tasks_per_driver
+        self.launch_attempts = launch_attempts
+        self.launches = 0
+        self.launch_failures = 0
+        self.recycles = 0
+        self._available: asyncio.Queue = asyncio.Queue()
+        self._browsers: List[PooledBrowser] = []
+
+    async def _launch(self, browser_id: int) -> PooledBrowser:
+        loop = asyncio.get_running_loop()
+        driver = await loop.run_in_executor(None, functools.partial(
+            launch_chrome, self.headless, images=not self.load_profile.image_placeholders,
+            performance_log=needs_performance_log(self.load_profile)
+        ))
+        self.launches += 1
+        return PooledBrowser(driver=driver, browser_id=browser_id)
+
+    async def start(self):
+        start = time.perf_counter()
+        launched = await asyncio.gather(*(self._launch(i) for i in range(self.size)), return_exceptions=True)
+        self._browsers = [browser for browser in launched if isinstance(browser, PooledBrowser)]
+        errors = [error for error in launched if isinstance(error, BaseException)]
+        if errors:
+            # Quit the browsers that did launch so they are not left running
+            self.launch_failures += len(errors)
+            await self.close()
+            raise errors[0]
+        for browser in self._browsers:
+            self._available.put_nowait(browser)
+        print(f"Browser pool ready: {self.size} browser(s) in {time.perf_counter() - start:.1f} s")
+
+    async def acquire(self) -> PooledBrowser:
+        browser = await self._available.get()
+        if browser is None:
+            # Pass the "pool is empty" marker on to the next waiter
+            self._available.put_nowait(None)
+            raise RuntimeError("No browsers left in the pool")
+        return browser
+
+    async def release(self, browser: PooledBrowser):
+        loop = asyncio.get_running_loop()
+        browser.tasks_run += 1
+
+        healthy = browser.tasks_run < self.max_tasks_per_driver
+        if healthy:
+            try:
+                await loop.run_in_executor(None, reset_browser_state, browser.driver)
+            except Exception as e:
+                print(f"Browser {browser.browser_id} failed to reset, recycling: {e}")
+                healthy = False
+
+        if not healthy:
+            await loop.run_in_executor(None, self._quit, browser.driver)
+            self._browsers.remove(browser)
+            browser = await self._relaunch(browser.browser_id)
+            if browser is None:
+                if not self._browsers:
+                    self._available.put_nowait(None)
+                return
+            self._browsers.append(browser)
+            self.recycles += 1
+
+        self._available.put_nowait(browser)
+
+    async def _relaunch(self, browser_id: int) -> Optional[PooledBrowser]:
+        for attempt in range(self.launch_attempts):
+            try:
+                return await self._launch(browser_id)
+            except Exception as e:
+                self.launch_failures += 1
+                print(f"Browser {browser_id} failed to relaunch (attempt {attempt + 1}/{self.launch_attempts}): {e}")
+        print(f"Dropping browser {browser_id}, {len(self._browsers)} left in the pool")
+        return None
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, self._quit, b.driver) for b in self._browsers))
+        self._browsers = []
+
+def load_jobs(path: str) -> List[Dict]:
+    jobs = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if "url" not in job or "task" not in job:
+                raise ValueError(f"{path}:{line_number}: each job needs 'url' and 'task'")
+            job.setdefault("id", str(line_number))
+            jobs.append(job)
+    return jobs
+
+async def run_jobs(jobs: List[Dict], results_path: str, api_key: str, workers: int = 2, headless: bool = True,
+                   max_tasks_per_driver: int = 20, decision_cache: Optional[DecisionCache] = None,
+                   trajectory_store: Optional[TrajectoryStore] = None, load_profile: str = "full",
+                   rate_limiter: Optional[RateLimiter] = None) -> Dict:
+    rate_limiter = rate_limiter or RateLimiter.shared()
+    pool = BrowserPool(size=workers, headless=headless, max_tasks_per_driver=max_tasks_per_driver, load_profile=load_profile)
+    # One Gemini client for every job, created while the browsers launch
+    loop = asyncio.get_running_loop()
+    started, model = await asyncio.gather(pool.start(), loop.run_in_executor(None, create_model, api_key),
+                                          return_exceptions=True)
+    for error in (started, model):
+        if isinstance(error, BaseException):
+            await pool.close()
+            raise error
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    completed = 0
+    succeeded = 0
+    succeeded_steps = 0
+    start = time.perf_counter()
+
+    with open(results_path, 'a') as results_file:
+        async def worker():
+            nonlocal completed, succeeded, succeeded_steps
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                try:
+                    browser = await pool.acquire()
+                except RuntimeError as e:
+                    print(f"Job {job['id']} not run: {e}")
+                    results_file.write(json.dumps({"id": job["id"], "url": job["url"], "task": job["task"], "success": False,
+                                                   "steps": 0, "reason": None, "error": str(e)}) + "\n")
+                    results_file.flush()
+                    completed += 1
+                    continue
+                print(f"[browser {browser.browser_id}] job {job['id']} started, queue depth {queue.qsize()}")
+
+                task_start = time.perf_counter()
+                result = {"id": job["id"], "url": job["url"], "task": job["task"], "success": False, "steps": 0,
+                          "reason": None, "error": None}
+                agent = None
+                try:
+                    agent = await WebNavigationAgent.create(
+                        api_key, headless=headless, driver=browser.driver, model=model, decision_cache=decision_cache,
+                        trajectory_store=trajectory_store, load_profile=load_profile, rate_limiter=rate_limiter
+                    )
+                    task_result = await agent.perform_task(job["url"], job["task"], job.get("max_steps", 10))
+                    result.update(success=task_result.success, steps=task_result.steps, reason=task_result.reason)
+                except Exception as e:
+                    result["error"] = str(e)
+                finally:
+                    if agent is not None:
+                        agent.close()
+                    await pool.release(browser)
+
+                result["wall_time_s"] = round(time.perf_counter() - task_start, 2)
+                result["browser_id"] = browser.browser_id
+                results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+
+                completed += 1
+                succeeded += result["success"]
+                if result["success"]:
+                    succeeded_steps += result["steps"]
+                elapsed_min = (time.perf_counter() - start) / 60
+                print(f"[browser {browser.browser_id}] job {job['id']} finished in {result['wall_time_s']} s "
+                      f"({completed}/{len(jobs)} done, {completed / elapsed_min:.1f} jobs/min)")
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        finally:
+            await pool.close()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "jobs": len(jobs),
+        "completed": completed,
+        "succeeded": succeeded,
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_minute": round(completed / (elapsed / 60), 2) if elapsed else 0.0,
+        "steps_per_completed_task": round(succeeded_steps / succeeded, 2) if succeeded else 0.0,
+        "browser_launches": pool.launches,
+        "browser_recycles": pool.recycles,
+        "browser_launch_failures": pool.launch_failures,
+        "rate_limiter": rate_limiter.metrics()
+    }
+    return summary
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run many (url, task) jobs over a pool of warm browsers")
+    parser.add_argument("jobs", help="JSONL file with one {\"url\", \"task\", \"max_steps\"} object per line")
+    parser.add_argument("results", help="JSONL file results are appended to as jobs finish")
+    parser.add_argument("--workers", type=int, default=2, help="number of browsers / concurrent tasks")
+    parser.add_argument("--max-tasks-per-driver", type=int, default=20, help="relaunch a browser after this many tasks")
+    parser.add_argument("--show-browser", action="store_true", help="run Chrome with a visible window")
+    parser.add_argument("--decision-cache", help="path of a decision cache shared by all tasks")
+    parser.add_argument("--trajectories", help="directory of recorded trajectories to replay and update")
+    parser.add_argument("--rpm", type=float, help="Gemini requests per minute shared by all workers (default GEMINI_RPM or 60)")
+    parser.add_argument("--tpm", type=float, help="Gemini tokens per minute shared by all workers (default GEMINI_TPM or 1,000,000)")
+    parser.add_argument("--load-profile", choices=sorted(LOAD_PROFILES), default="full", help="resources to block while pages load")
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        raise ValueError("GOOGLE_API_KEY not found in .env file")
+
+    jobs = load_jobs(args.jobs)
+    print(f"Loaded {len(jobs)} job(s) from {args.jobs}")
+
+    decision_cache = DecisionCache(path=args.decision_cache) if args.decision_cache else None
+    summary = await run_jobs(
+        jobs, args.results, api_key,
+        workers=args.workers,
+        headless=not args.show_browser,
+        max_tasks_per_driver=args.max_tasks_per_driver,
+        decision_cache=decision_cache,
+        trajectory_store=TrajectoryStore(args.trajectories) if args.trajectories else None,
+        load_profile=args.load_profile,
+        rate_limiter=RateLimiter(
+            requests_per_minute=args.rpm or RateLimiter.shared().requests_per_minute,
+            tokens_per_minute=args.tpm or RateLimiter.shared().tokens_per_minute
+        )
+    )
+    if decision_cache is not None:
+        decision_cache.save()
+
+    print(f"\nRun complete: {json.dumps(summary)}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from using_selenium import RateLimiter, StreamingJsonParser, Tracer, WebNavigationAgent
+
+# Escaped quotes and backslashes, brackets inside strings, nested arrays and objects, unicode escapes
+SAMPLE = {
+    "action": {
+        "next_action": "type",
+        "target_element": "12",
+        "input_text": "say \"hi\", then {leave} [now] \\ back",
+        "submit": True,
+        "confidence": 8
+    },
+    "followup": {
+        "plan": [
+            {"action": "click", "target_element": "3", "precondition": {"url_contains": "/search?q=[x]"}},
+            {"action": "scroll", "scroll_direction": "down"}
+        ],
+        "alternative_actions": ["4", "//div[@id=\"a,b\"]", ["nested", ["deeper"]]]
+    },
+    "notes": {
+        "task_progress": "half way, été",
+        "reasoning": "",
+        "analysis": "line one\nline two \"quoted\" }"
+    }
+}
+
+EXPECTED_PATHS = [
+    ("action", "next_action"), ("action", "target_element"), ("action", "input_text"), ("action", "submit"),
+    ("action", "confidence"), ("action",),
+    ("followup", "plan"), ("followup", "alternative_actions"), ("followup",),
+    ("notes", "task_progress"), ("notes", "reasoning"), ("notes", "analysis"), ("notes",)
+]
+
+LAYOUTS = {
+    "compact": json.dumps(SAMPLE),
+    "indented": json.dumps(SAMPLE, indent=2),
+    "ascii escapes": json.dumps(SAMPLE, ensure_ascii=True, separators=(",", ":"))
+}
+
+def feed_in_chunks(text: str, sizes) -> list:
+    parser = StreamingJsonParser()
+    completed = []
+    position = 0
+    for size in sizes:
+        if position >= len(text):
+            break
+        completed.extend(parser.feed(text[position:position + size]))
+        position += size
+    completed.extend(parser.feed(text[position:]))
+    assert parser.result() == SAMPLE
+    return completed
+
+def check_fields(completed: list):
+    assert [path for path, _ in completed] == EXPECTED_PATHS
+    for path, value in completed:
+        expected = SAMPLE
+        for key in path:
+            expected = expected[key]
+        assert value == expected, path
+
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_single_character_chunks(layout):
+    text = LAYOUTS[layout]
+    check_fields(feed_in_chunks(text, [1] * len(text)))
+
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_one_chunk(layout):
+    text = LAYOUTS[layout]
+    check_fields(feed_in_chunks(text, [len(text)]))
+
+@pytest.mark.parametrize("layout", sorted(LAYOUTS))
+def test_random_chunks(layout):
+    rng = random.Random(0)
+    text = LAYOUTS[layout]
+    for _ in range(200):
+        check_fields(feed_in_chunks(text, [rng.randint(1, 9) for _ in range(len(text))]))
+
+def test_truncated_stream_keeps_completed_fields():
+    text = json.dumps(SAMPLE)
+    parser = StreamingJsonParser()
+    paths = [path for path, _ in parser.feed(text[:text.index('"analysis"')])]
+    assert ("action",) in paths and ("followup",) in paths
+    with pytest.raises(json.JSONDecodeError):
+        parser.result()
+
+def test_flatten_response():
+    flat = WebNavigationAgent._flatten_response(SAMPLE)
+    assert flat["next_action"] == "type"
+    assert flat["plan"] == SAMPLE["followup"]["plan"]
+    assert flat["analysis"] == SAMPLE["notes"]["analysis"]
+
+class GatedStream:
+    """Streams the action, then holds the follow-up back until the action has been dispatched"""
+    usage_metadata = None
+
+    def __init__(self, text: str, dispatched: asyncio.Event):
+        split = text.index('"followup"')
+        self.chunks = [text[:split], text[split:]]
+        self.dispatched = dispatched
+
+    async def __aiter__(self):
+        yield type("Chunk", (), {"text": self.chunks[0]})()
+        await asyncio.wait_for(self.dispatched.wait(), timeout=5)
+        yield type("Chunk", (), {"text": self.chunks[1]})()
+
+def test_action_dispatched_before_followup_arrives():
+    agent = object.__new__(WebNavigationAgent)
+    agent.tracer = Tracer()
+    agent.rate_limiter = RateLimiter()
+    agent.metrics = {"prompt_tokens": 0}
+    agent._handles = {}
+    agent._pending_followup = None
+    dispatched = asyncio.Event()
+    seen = {}
+
+    async def generate(*args, **kwargs):
+        return GatedStream(json.dumps(SAMPLE), dispatched)
+
+    async def on_action(response):
+        seen["plan_at_dispatch"] = response["plan"]
+        dispatched.set()
+        # execute_plan runs on a driver thread and blocks there until the follow-up is complete
+        await asyncio.get_running_loop().run_in_executor(None, agent._merge_followup, response)
+        seen["plan_after_merge"] = response["plan"]
+
+    agent._generate = generate
+    _, ai_response = asyncio.run(agent._stream_response([], "", 0, 0, 0, on_action=on_action))
+    assert seen["plan_at_dispatch"] == []
+    assert seen["plan_after_merge"] == SAMPLE["followup"]["plan"]
+    assert ai_response["alternative_actions"] == SAMPLE["followup"]["alternative_actions"]
+    assert ai_response["analysis"] == SAMPLE["notes"]["analysis"]
+    assert agent._pending_followup is None
@@ -1,31 +1,166 @@
+import argparse
 import asyncio
+import json
 import os
+import socket
+import time
+from typing import Dict, List
 from browser_use import BrowserSession, Agent
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 
-async def main():
-    load_dotenv()
+from run_tasks import load_jobs
+
+DEMO_TASK = "Go to amazon.in, search for 'laptops', sort by best sellers and add the first item to the cart."
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class SessionPool:
+    """keep_alive browsers started once and shared by every task. Each browser runs up to tabs_per_session
+    agents at a time. Every tab slot has a BrowserSession of its own attached to the browser over CDP, so
+    agents keep separate focus and never act on each other's tabs; each task opens a new tab in its slot's
+    session and closes it when the task ends."""
+    def __init__(self, size: int = 1, tabs_per_session: int = 4, headless: bool = True):
+        self.size = size
+        self.tabs_per_session = tabs_per_session
+        self.headless = headless
+        self.sessions: List[BrowserSession] = []
+        self.tab_sessions: List[BrowserSession] = []
+        self._slots: asyncio.Queue = asyncio.Queue()
     
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        raise ValueError("GOOGLE_API_KEY not found in environment variables. Please add it to your .env file.")
+    async def _start_all(self, sessions: List[BrowserSession]):
+        started = await asyncio.gather(*(session.start() for session in sessions), return_exceptions=True)
+        errors = [error for error in started if isinstance(error, BaseException)]
+        if errors:
+            # Close the sessions that did start so their browsers are not left running
+            await self.close()
+            raise errors[0]
     
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.0-flash",
-        temperature=0.1,
-        google_api_key=os.environ.get('GOOGLE_API_KEY')
-    )
+    async def start(self):
+        start = time.perf_counter()
+        ports = [free_port() for _ in range(self.size)]
+        self.sessions = [BrowserSession(keep_alive=True, headless=self.headless, args=[f"--remote-debugging-port={port}"])
+                         for port in ports]
+        await self._start_all(self.sessions)
+        
+        for session, port in zip(self.sessions, ports):
+            cdp_url = getattr(session, "cdp_url", None) or f"http://127.0.0.1:{port}"
+            self.tab_sessions.extend(BrowserSession(keep_alive=True, cdp_url=cdp_url) for _ in range(self.tabs_per_session))
+        await self._start_all(self.tab_sessions)
+        for slot in range(len(self.tab_sessions)):
+            self._slots.put_nowait(slot)
+        print(f"Session pool ready: {self.size} session(s), {self.tabs_per_session} tab(s) each, "
+              f"in {time.perf_counter() - start:.1f} s")
+    
+    def session_id(self, slot: int) -> int:
+        return slot // self.tabs_per_session
+    
+    async def acquire(self) -> int:
+        return await self._slots.get()
     
+    def release(self, slot: int):
+        self._slots.put_nowait(slot)
+    
+    async def close(self):
+        # Detach the tab sessions before closing the browsers they are attached to
+        await asyncio.gather(*(session.close() for session in self.tab_sessions), return_exceptions=True)
+        await asyncio.gather(*(session.close() for session in self.sessions), return_exceptions=True)
+        self.tab_sessions = []
+        self.sessions = []
+
+async def run_agent_jobs(jobs: List[Dict], results_path: str, llm: ChatGoogleGenerativeAI, sessions: int = 1,
+                         tabs_per_session: int = 4, headless: bool = True) -> Dict:
+    """Run jobs concurrently (sessions * tabs_per_session at a time) with one shared LLM client, appending
+    results to results_path in the same JSONL format as run_tasks.py so the two backends can be compared"""
+    pool = SessionPool(size=sessions, tabs_per_session=tabs_per_session, headless=headless)
+    await pool.start()
+    
+    completed = 0
+    succeeded = 0
+    succeeded_steps = 0
+    start = time.perf_counter()
+    
+    with open(results_path, 'a') as results_file:
+        async def run_job(job: Dict):
+            nonlocal completed, succeeded, succeeded_steps
+            slot = await pool.acquire()
+            session_id = pool.session_id(slot)
+            session = pool.tab_sessions[slot]
+            print(f"[session {session_id}] job {job['id']} started")
+            
+            task_start = time.perf_counter()
+            result = {"id": job["id"], "url": job["url"], "task": job["task"], "success": False, "steps": 0,
+                      "reason": None, "error": None}
+            page = None
+            try:
+                page = await session.browser_context.new_page()
+                agent = Agent(
+                    task=job["task"],
+                    llm=llm,
+                    browser_session=session,
+                    page=page,
+                    initial_actions=[{"go_to_url": {"url": job["url"]}}]
+                )
+                history = await agent.run(max_steps=job.get("max_steps", 10))
+                result.update(
+                    success=bool(history.is_done() and history.is_successful()),
+                    steps=history.number_of_steps(),
+                    reason="done" if history.is_done() else "max_steps"
+                )
+                errors = [error for error in history.errors() if error]
+                if errors and not history.is_done():
+                    result["error"] = errors[-1]
+            except Exception as e:
+                result["error"] = str(e)
+            finally:
+                if page is not None:
+                    try:
+                        await page.close()
+                    except Exception:
+                        pass
+                pool.release(slot)
+            
+            result["wall_time_s"] = round(time.perf_counter() - task_start, 2)
+            result["session_id"] = session_id
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+            
+            completed += 1
+            succeeded += result["success"]
+            if result["success"]:
+                succeeded_steps += result["steps"]
+            elapsed_min = (time.perf_counter() - start) / 60
+            print(f"[session {session_id}] job {job['id']} finished in {result['wall_time_s']} s "
+                  f"({completed}/{len(jobs)} done, {completed / elapsed_min:.1f} jobs/min)")
+        
+        try:
+            await asyncio.gather(*(run_job(job) for job in jobs))
+        finally:
+            await pool.close()
+    
+    elapsed = time.perf_counter() - start
+    return {
+        "jobs": len(jobs),
+        "completed": completed,
+        "succeeded": succeeded,
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_minute": round(completed / (elapsed / 60), 2) if elapsed else 0.0,
+        "steps_per_completed_task": round(succeeded_steps / succeeded, 2) if succeeded else 0.0,
+        "sessions": sessions,
+        "tabs_per_session": tabs_per_session
+    }
+
+async def run_demo(llm: ChatGoogleGenerativeAI):
     browser_session = BrowserSession(keep_alive=True)
     
     await browser_session.start()
     
     try:
-        task = "Go to amazon.in, search for 'laptops', sort by best sellers and add the first item to the cart."
-        
         agent = Agent(
-            task=task,
+            task=DEMO_TASK,
             llm=llm,
             browser_session=browser_session
         )
@@ -36,5 +171,40 @@ async def main():
     finally:
         await browser_session.close()
 
+async def main():
+    parser = argparse.ArgumentParser(description="Run the browser-use demo task, or a JSONL file of jobs in parallel tabs")
+    parser.add_argument("jobs", nargs="?", help="JSONL file with one {\"url\", \"task\", \"max_steps\"} object per line")
+    parser.add_argument("results", nargs="?", default="browser_use_results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--sessions", type=int, default=1, help="number of keep_alive browser sessions")
+    parser.add_argument("--tabs-per-session", type=int, default=4, help="concurrent tasks (tabs) per session")
+    parser.add_argument("--show-browser", action="store_true", help="run the browser with a visible window")
+    args = parser.parse_args()
+    
+    load_dotenv()
+    
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if not api_key:
+        raise ValueError("GOOGLE_API_KEY not found in environment variables. Please add it to your .env file.")
+    
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        temperature=0.1,
+        google_api_key=api_key
+    )
+    
+    if not args.jobs:
+        await run_demo(llm)
+        return
+    
+    jobs = load_jobs(args.jobs)
+    print(f"Loaded {len(jobs)} job(s) from {args.jobs}")
+    summary = await run_agent_jobs(
+        jobs, args.results, llm,
+        sessions=args.sessions,
+        tabs_per_session=args.tabs_per_session,
+        headless=not args.show_browser
+    )
+    print(f"\nRun complete: {json.dumps(summary)}")
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -1,89 +1,2268 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
 import asyncio
 import json
 import base64
-import time
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import TimeoutException, NoSuchElementException, ElementClickInterceptedException
-import google.generativeai as genai
-from PIL import Image
+import struct
+import importlib
+import hashlib
+import heapq
+import itertools
+import random
+import re
+import functools
+import contextvars
+import threading
+import queue
+import shutil
+import subprocess
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple, Union
+from dataclasses import dataclass, field
 from io import BytesIO
-import requests
 import os
 from dotenv import load_dotenv
 
+# Wall time of each deferred import, in ms, filled in as modules are first used
+IMPORT_TIMINGS: Dict[str, float] = {}
+
+class _LazyImport:
+    """Stands in for a module (or one of its attributes) and imports it on first use.
+    Selenium, Gemini and PIL cost about a second to import, most of it google.generativeai, which a
+    process that only replays trajectories or waits for daemon tasks may never need."""
+    def __init__(self, module: str, attribute: Optional[str] = None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+    
+    def _resolve(self):
+        if self._target is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self._module)
+            IMPORT_TIMINGS.setdefault(self._module, round((time.perf_counter() - start) * 1000, 1))
+            self._target = getattr(module, self._attribute) if self._attribute else module
+        return self._target
+    
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+    
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+webdriver = _LazyImport("selenium.webdriver")
+Options = _LazyImport("selenium.webdriver.chrome.options", "Options")
+By = _LazyImport("selenium.webdriver.common.by", "By")
+WebDriverWait = _LazyImport("selenium.webdriver.support.ui", "WebDriverWait")
+EC = _LazyImport("selenium.webdriver.support.expected_conditions")
+ActionChains = _LazyImport("selenium.webdriver.common.action_chains", "ActionChains")
+Keys = _LazyImport("selenium.webdriver.common.keys", "Keys")
+# except clauses need the real classes, so they name them through the module: selenium_exceptions.TimeoutException
+selenium_exceptions = _LazyImport("selenium.common.exceptions")
+genai = _LazyImport("google.generativeai")
+Image = _LazyImport("PIL.Image")
+ImageDraw = _LazyImport("PIL.ImageDraw")
+
 load_dotenv()
+MODULE_IMPORT_MS = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
+@dataclass
+class ElementInfo:
+    tag: str
+    text: str
+    xpath: str
+    attributes: Dict[str, str]
+    coordinates: Tuple[int, int, int, int]
+    element_id: str
+    handle: Optional[int] = None
+
+    @classmethod
+    def from_compact(cls, row: List) -> "ElementInfo":
+        """Build an ElementInfo from a row returned by EXTRACT_ELEMENTS_SCRIPT or SNAPSHOT_ELEMENTS_SCRIPT"""
+        tag, text, xpath, attributes, rect, index = row[:6]
+        handle = row[6] if len(row) > 6 else None
+        return cls(
+            tag=tag,
+            text=text,
+            xpath=xpath,
+            attributes=attributes,
+            coordinates=tuple(rect),
+            element_id=f"{tag}_{handle}" if handle is not None else f"{tag}_{index}",
+            handle=handle
+        )
+
+@dataclass
+class ElementDelta:
+    full: bool
+    version: int
+    added: List[ElementInfo]
+    changed: List[ElementInfo]
+    removed: List[ElementInfo]
+
+ELEMENT_SELECTORS = [
+    "//button", "//input", "//select", "//textarea", 
+    "//a[@href]", "//div[@onclick]", "//span[@onclick]",
+    "//div[@role='button']", "//div[@role='link']",
+    "//div[@role='tab']", "//div[@role='menuitem']",
+    "//h1/a", "//h2/a", "//h3/a", "//h4/a", "//h5/a", "//h6/a",
+    "//li/a", "//p/a", "//span/a",
+    "//div[@tabindex]", "//span[@tabindex]",
+    "//form", "//label[@for]"
+]
+
+# The same candidates as ELEMENT_SELECTORS in a single CSS selector, so ranking
+# can find them in one document traversal instead of one per XPath
+ELEMENT_CSS_SELECTOR = ", ".join([
+    "button", "input", "select", "textarea",
+    "a[href]", "div[onclick]", "span[onclick]",
+    "div[role='button']", "div[role='link']",
+    "div[role='tab']", "div[role='menuitem']",
+    "h1 > a", "h2 > a", "h3 > a", "h4 > a", "h5 > a", "h6 > a",
+    "li > a", "p > a", "span > a",
+    "div[tabindex]", "span[tabindex]",
+    "form", "label[for]"
+])
+
+ELEMENT_ATTRIBUTES = ['id', 'class', 'name', 'type', 'href', 'title', 'placeholder', 'value', 'role', 'aria-label', 'data-testid']
+
+XPATH_FUNCTION_JS = """
+    function getXPath(element) {
+        if (element.id !== '') {
+            return `//*[@id="${element.id}"]`;
+        }
+        if (element === document.body) {
+            return '/html/body';
+        }
+        
+        var ix = 0;
+        var siblings = element.parentNode.childNodes;
+        for (var i = 0; i < siblings.length; i++) {
+            var sibling = siblings[i];
+            if (sibling === element) {
+                return getXPath(element.parentNode) + '/' + element.tagName.toLowerCase() + '[' + (ix + 1) + ']';
+            }
+            if (sibling.nodeType === 1 && sibling.tagName === element.tagName) {
+                ix++;
+            }
+        }
+    }
+"""
+
+# Collects every interactive element in a single round trip. Mirrors the
+# per-element WebDriver calls of the XPath extractor (is_displayed, rect,
+# tag_name, text, get_attribute, _get_xpath) and applies the cap in-page.
+COLLECT_ELEMENTS_JS = XPATH_FUNCTION_JS + """
+    function isDisplayed(element) {
+        if (element.checkVisibility) {
+            return element.checkVisibility({opacityProperty: true, visibilityProperty: true});
+        }
+        var style = window.getComputedStyle(element);
+        return element.getClientRects().length > 0 && style.visibility !== 'hidden' && style.opacity !== '0';
+    }
+    
+    function getAttributes(element, attrNames) {
+        var attributes = {};
+        for (var i = 0; i < attrNames.length; i++) {
+            var name = attrNames[i];
+            var value = null;
+            if ((name === 'href' || name === 'value') && typeof element[name] === 'string') {
+                value = element[name];
+            } else {
+                value = element.getAttribute(name);
+            }
+            if (value) {
+                attributes[name] = value.slice(0, 100);
+            }
+        }
+        return attributes;
+    }
+    
+    function buildRow(element, rect, attrNames, index) {
+        return [
+            element.tagName.toLowerCase(),
+            (element.innerText || '').trim().slice(0, 100),
+            getXPath(element) || '',
+            getAttributes(element, attrNames),
+            [rect.left + window.scrollX, rect.top + window.scrollY, rect.width, rect.height],
+            index
+        ];
+    }
+    
+    function collectElements(selectors, attrNames, maxElements) {
+        var collected = [];
+        for (var s = 0; s < selectors.length && collected.length < maxElements; s++) {
+            var result;
+            try {
+                result = document.evaluate(selectors[s], document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            } catch (e) {
+                continue;
+            }
+            for (var i = 0; i < result.snapshotLength && collected.length < maxElements; i++) {
+                var element = result.snapshotItem(i);
+                try {
+                    if (!isDisplayed(element)) {
+                        continue;
+                    }
+                    var rect = element.getBoundingClientRect();
+                    if (rect.width === 0 || rect.height === 0) {
+                        continue;
+                    }
+                    collected.push({element: element, row: buildRow(element, rect, attrNames, i)});
+                } catch (e) {
+                    continue;
+                }
+            }
+        }
+        return collected;
+    }
+    
+    var STOPWORDS = {
+        'a': 1, 'an': 1, 'the': 1, 'and': 1, 'or': 1, 'to': 1, 'of': 1, 'on': 1, 'in': 1, 'into': 1, 'for': 1,
+        'with': 1, 'then': 1, 'it': 1, 'is': 1, 'go': 1, 'click': 1, 'press': 1, 'type': 1, 'enter': 1,
+        'find': 1, 'open': 1, 'please': 1, 'page': 1, 'website': 1, 'site': 1
+    };
+    var NATIVE_CONTROLS = {'a': 1, 'button': 1, 'input': 1, 'select': 1, 'textarea': 1};
+    var ROLE_WEIGHTS = {
+        'input': 0.8, 'textarea': 0.8, 'select': 0.7, 'button': 0.5, 'a': 0.3,
+        'div': 0.2, 'span': 0.2, 'label': 0.1, 'form': 0
+    };
+    
+    function taskTerms(task) {
+        var seen = {};
+        return (task.toLowerCase().match(/[a-z0-9]+/g) || []).filter(function (term) {
+            if (term.length < 2 || STOPWORDS[term] || seen[term]) {
+                return false;
+            }
+            seen[term] = true;
+            return true;
+        });
+    }
+    
+    // Terms match whole words, so "ai" does not match "mail"
+    function wordsOf(text) {
+        return new Set(text.match(/[a-z0-9]+/g) || []);
+    }
+    
+    // Scores every visible candidate against the task (lexical overlap with text,
+    // aria-label, placeholder, title, name), plus viewport, size and role, and keeps
+    // the top maxElements. innerText, XPath and attributes are only computed for
+    // the survivors, which keeps this fast on pages with tens of thousands of nodes.
+    function rankElements(cssSelector, attrNames, maxElements, task) {
+        var terms = taskTerms(task);
+        var nodes = document.querySelectorAll(cssSelector);
+        var viewportWidth = window.innerWidth, viewportHeight = window.innerHeight;
+        var textCache = new Map();
+        function textOf(element) {
+            var text = textCache.get(element);
+            if (text === undefined) {
+                text = (element.textContent || '').trim().slice(0, 300).toLowerCase();
+                textCache.set(element, text);
+            }
+            return text;
+        }
+        
+        var candidates = [], candidateSet = new Set();
+        for (var i = 0; i < nodes.length; i++) {
+            var element = nodes[i];
+            if (!isDisplayed(element)) {
+                continue;
+            }
+            var rect = element.getBoundingClientRect();
+            if (rect.width === 0 || rect.height === 0) {
+                continue;
+            }
+            candidates.push({element: element, rect: rect, index: i});
+            candidateSet.add(element);
+        }
+        
+        // Nested matches with the same text (a link inside a clickable wrapper) describe
+        // one target: keep the native control, otherwise the innermost element.
+        var redundant = new Set();
+        candidates.forEach(function (candidate) {
+            var ancestor = candidate.element.parentElement;
+            for (var depth = 0; ancestor && depth < 3; depth++, ancestor = ancestor.parentElement) {
+                if (candidateSet.has(ancestor) && textOf(ancestor) === textOf(candidate.element)) {
+                    redundant.add(NATIVE_CONTROLS[ancestor.tagName.toLowerCase()] ? candidate.element : ancestor);
+                }
+            }
+        });
+        
+        candidates = candidates.filter(function (candidate) { return !redundant.has(candidate.element); });
+        candidates.forEach(function (candidate) {
+            var element = candidate.element, rect = candidate.rect;
+            var fields = [
+                [wordsOf(textOf(element)), 1.0],
+                [wordsOf((element.getAttribute('aria-label') || '').toLowerCase()), 1.0],
+                [wordsOf((element.getAttribute('placeholder') || '').toLowerCase()), 1.2],
+                [wordsOf((element.getAttribute('title') || '').toLowerCase()), 0.8],
+                [wordsOf((element.getAttribute('name') || '').toLowerCase()), 0.5]
+            ];
+            var lexical = 0;
+            for (var t = 0; t < terms.length; t++) {
+                var best = 0;
+                for (var f = 0; f < fields.length; f++) {
+                    if (fields[f][1] > best && fields[f][0].has(terms[t])) {
+                        best = fields[f][1];
+                    }
+                }
+                lexical += best;
+            }
+            if (terms.length) {
+                lexical /= terms.length;
+            }
+            
+            var inViewport = rect.bottom > 0 && rect.right > 0 && rect.top < viewportHeight && rect.left < viewportWidth;
+            var size = Math.min(1, rect.width * rect.height / 20000);
+            var tag = element.tagName.toLowerCase();
+            var role = element.getAttribute('role') ? 0.5 : (ROLE_WEIGHTS[tag] || 0.2);
+            candidate.score = 3 * lexical + (inViewport ? 1 : 0) + 0.5 * size + role;
+        });
+        
+        candidates.sort(function (a, b) { return b.score - a.score || a.index - b.index; });
+        return candidates.slice(0, maxElements).map(function (candidate) {
+            return {element: candidate.element, row: buildRow(candidate.element, candidate.rect, attrNames, candidate.index)};
+        });
+    }
+    
+    // rankTask is null for document order, otherwise the task to rank against
+    function findElements(selectors, attrNames, maxElements, rankTask, cssSelector) {
+        if (rankTask === null || rankTask === undefined) {
+            return collectElements(selectors, attrNames, maxElements);
+        }
+        return rankElements(cssSelector, attrNames, maxElements, rankTask);
+    }
+"""
+
+# Returns the element references alongside the rows so WebDriver hands them back
+# as WebElements and actions don't have to locate them again
+EXTRACT_ELEMENTS_SCRIPT = COLLECT_ELEMENTS_JS + """
+    var items = findElements(arguments[0], arguments[1], arguments[2], arguments[3], arguments[4]);
+    return {
+        rows: items.map(function (item) { return item.row; }),
+        elements: items.map(function (item) { return item.element; })
+    };
+"""
+
+# Keeps a versioned element registry in the page. A MutationObserver installed
+# once per document marks the registry dirty; clean calls return an empty delta
+# without touching the DOM, dirty calls rescan and return only the rows that
+# were added, changed or removed. A new document (navigation) starts over with
+# a full snapshot. Rows carry a handle that is stable for the document, and
+# element references are returned for every added or changed row.
+SNAPSHOT_ELEMENTS_SCRIPT = COLLECT_ELEMENTS_JS + """
+    var selectors = arguments[0], attrNames = arguments[1], maxElements = arguments[2], forceFull = arguments[3];
+    var rankTask = arguments[4], cssSelector = arguments[5];
+    var state = window.__agentSnapshot;
+    var full = !!forceFull;
+    if (!state || state.document !== document) {
+        state = window.__agentSnapshot = {document: document, ids: new WeakMap(), nextId: 1, version: 0, dirty: true, rows: {}};
+        state.observer = new MutationObserver(function () { state.dirty = true; });
+        state.observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+        window.addEventListener('resize', function () { state.dirty = true; });
+        if (rankTask !== null && rankTask !== undefined) {
+            // Ranking favours elements in the viewport, so scrolling can change the selection
+            window.addEventListener('scroll', function () { state.dirty = true; }, {passive: true});
+        }
+        full = true;
+    }
+    if (!state.dirty && !full) {
+        return {full: false, version: state.version, added: [], changed: [], removed: [], added_elements: [], changed_elements: []};
+    }
+    state.dirty = false;
+    
+    var current = {}, added = [], changed = [], removed = [], addedElements = [], changedElements = [];
+    findElements(selectors, attrNames, maxElements, rankTask, cssSelector).forEach(function (item) {
+        var handle = state.ids.get(item.element);
+        if (!handle) {
+            handle = state.nextId++;
+            state.ids.set(item.element, handle);
+        }
+        if (handle in current) {
+            return;
+        }
+        var row = item.row;
+        var signature = JSON.stringify(row.slice(0, 5));
+        row.push(handle);
+        current[handle] = signature;
+        if (full || !(handle in state.rows)) {
+            added.push(row);
+            addedElements.push(item.element);
+        } else if (state.rows[handle] !== signature) {
+            changed.push(row);
+            changedElements.push(item.element);
+        }
+    });
+    for (var handle in state.rows) {
+        if (!(handle in current)) {
+            removed.push(Number(handle));
+        }
+    }
+    state.rows = current;
+    state.version++;
+    return {
+        full: full, version: state.version, added: added, changed: changed, removed: removed,
+        added_elements: addedElements, changed_elements: changedElements
+    };
+"""
+
+@dataclass
+class ScreenshotConfig:
+    """How screenshots are encoded before being sent to the model.
+    region is None for the viewport or an XPath to crop to a single element."""
+    max_width: int = 1280
+    max_height: int = 1280
+    format: str = "jpeg"
+    quality: int = 80
+    grayscale: bool = False
+    region: Optional[str] = None
+
+@dataclass
+class Screenshot:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    capture_ms: float
+    encode_ms: float
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def as_part(self) -> Dict:
+        """Inline blob accepted by generate_content, no base64 or PIL round trip"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+SCREENSHOT_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+def encode_screenshot(png: bytes, config: ScreenshotConfig) -> Tuple[bytes, str, int, int]:
+    """Re-encode a PNG screenshot according to config. Returns (data, mime_type, width, height)"""
+    if config.format not in SCREENSHOT_FORMATS:
+        raise ValueError(f"Unknown screenshot format: {config.format}")
+    pil_format, mime_type = SCREENSHOT_FORMATS[config.format]
+    
+    width, height = struct.unpack('>II', png[16:24])
+    if config.format == "png" and not config.grayscale and width <= config.max_width and height <= config.max_height:
+        return png, mime_type, width, height
+    
+    image = Image.open(BytesIO(png))
+    image = image.convert('L' if config.grayscale else 'RGB')
+    if width > config.max_width or height > config.max_height:
+        image.thumbnail((config.max_width, config.max_height))
+    
+    buffer = BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, format=pil_format, compress_level=1)
+    else:
+        image.save(buffer, format=pil_format, quality=config.quality)
+    return buffer.getvalue(), mime_type, image.width, image.height
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini's image cost: 258 tokens for small images, otherwise 258 per 768x768 tile"""
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * -(-width // 768) * -(-height // 768)
+
+# Screenshot levels of the adaptive policy, cheapest first
+MODALITIES = ("text", "downscaled", "full")
+
+@dataclass
+class ModalityPolicy:
+    """When an adaptive agent escalates from a text-only prompt to a downscaled and then a full screenshot:
+    the model's confidence is below min_confidence, fewer than min_elements were extracted (canvas or
+    image-heavy pages, which then start at the downscaled level) or the previous step failed (likewise)."""
+    min_confidence: float = 6.0
+    min_elements: int = 5
+    downscaled: ScreenshotConfig = field(default_factory=lambda: ScreenshotConfig(max_width=640, max_height=640, quality=60))
+
+# Attributes that rarely help the model pick an element but cost many tokens
+REDUNDANT_ATTRIBUTES = {'class', 'data-testid'}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token), for when the model cannot count tokens"""
+    return len(text) // 4 + 1
+
+class TokenCounter:
+    """Token counts from the model's count_tokens, which runs Gemini's own tokenizer. A request per element row
+    would cost more than it saves, so every shape of text (element rows, prompts) is measured once and then
+    costed at its characters-per-token ratio; each exact count refines the ratio, and exact counts are cached
+    per text. Falls back to estimate_tokens when the model has no count_tokens or it fails."""
+    def __init__(self, model=None, max_cached: int = 256):
+        self.model = model if hasattr(model, "count_tokens") else None
+        self.max_cached = max_cached
+        self.calls = 0
+        self._ratios: Dict[str, float] = {}
+        self._exact: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def exact(self, text: str, shape: Optional[str] = None) -> Optional[int]:
+        """count_tokens for text (None if the model cannot count); a shape's ratio is updated from it"""
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            tokens = self._exact.get(key)
+            if tokens is not None:
+                self._exact.move_to_end(key)
+        if tokens is None:
+            if self.model is None:
+                return None
+            try:
+                tokens = self.model.count_tokens(text).total_tokens
+            except Exception as e:
+                print(f"count_tokens failed, estimating tokens from now on: {e}")
+                self.model = None
+                return None
+            with self._lock:
+                self.calls += 1
+                self._exact[key] = tokens
+                if len(self._exact) > self.max_cached:
+                    self._exact.popitem(last=False)
+        if shape is not None and tokens:
+            self._ratios[shape] = len(text) / tokens
+        return tokens
+    
+    def calibrate(self, shape: str, sample: str):
+        """Measure the shape's ratio on sample unless it is already known"""
+        if shape not in self._ratios and sample:
+            self.exact(sample, shape)
+    
+    def estimate(self, text: str, shape: str) -> int:
+        ratio = self._ratios.get(shape)
+        if ratio is None:
+            return estimate_tokens(text)
+        return int(len(text) / ratio) + 1
+    
+    def count(self, text: str, shape: str) -> int:
+        """Tokens in text at the shape's ratio, measuring the shape on this text if it is the first one"""
+        self.calibrate(shape, text)
+        return self.estimate(text, shape)
+    
+    def calibrated(self, shape: str) -> bool:
+        return shape in self._ratios
+
+def _compact_cell(value: str, limit: int) -> str:
+    return " ".join(value.replace("|", "/").split())[:limit]
+
+def compact_attributes(elem: ElementInfo) -> str:
+    parts = []
+    seen = {elem.text}
+    for name, value in elem.attributes.items():
+        if name in REDUNDANT_ATTRIBUTES or value in seen:
+            continue
+        seen.add(value)
+        if name == 'role' and value == elem.tag:
+            continue
+        if name == 'href':
+            value = value.split('://', 1)[-1]
+        value = _compact_cell(value, 60)
+        parts.append(f"{name}={json.dumps(value) if ' ' in value else value}")
+    return " ".join(parts)
+
+def serialize_elements_compact(elements: List[ElementInfo], token_budget: int, counter: Optional[TokenCounter] = None) -> str:
+    """One terse row per element, keyed by its numeric handle, cut off at token_budget. With a counter, rows
+    are costed at the model tokenizer's measured ratio and a table close to the budget is counted exactly
+    and trimmed until it fits."""
+    counter = counter or TokenCounter()
+    header = "id|tag|text|attributes"
+    rows = [f"{elem.handle}|{elem.tag}|{_compact_cell(elem.text, 80)}|{compact_attributes(elem)}" for elem in elements]
+    counter.calibrate("element_rows", "\n".join([header] + rows))
+    
+    lines = [header]
+    used = counter.estimate(header, "element_rows")
+    for row in rows:
+        cost = counter.estimate(row, "element_rows")
+        if used + cost > token_budget:
+            break
+        lines.append(row)
+        used += cost
+    
+    # The estimate is only as good as the ratio; near the budget, count the real table
+    if used > token_budget * 0.85:
+        while len(lines) > 1:
+            tokens = counter.exact("\n".join(lines), "element_rows")
+            if tokens is None or tokens <= token_budget:
+                break
+            keep = max(1, int((len(lines) - 1) * token_budget / tokens))
+            lines = lines[:1 + min(keep, len(lines) - 2)]
+    
+    hidden = len(elements) - (len(lines) - 1)
+    if hidden:
+        lines.append(f"({hidden} more elements not shown)")
+    return "\n".join(lines)
+
+def perceptual_hash(image_data: bytes) -> str:
+    """64-bit difference hash of an encoded image, stable across small rendering differences"""
+    image = Image.open(BytesIO(image_data))
+    image.draft('L', (image.width // 8, image.height // 8))
+    pixels = list(image.convert('L').resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def page_fingerprint(url: str, title: str, elements: List[ElementInfo], screenshot: Optional[Screenshot] = None) -> str:
+    """Cheap page-state fingerprint from the URL, title, the compact element list and the screenshot"""
+    digest = hashlib.sha1()
+    digest.update(f"{url}\n{title}\n".encode('utf-8'))
+    for elem in elements:
+        digest.update(json.dumps([elem.tag, elem.text, elem.xpath, elem.attributes], sort_keys=True).encode('utf-8'))
+    image_hash = perceptual_hash(screenshot.data) if screenshot else "-"
+    return f"{digest.hexdigest()[:20]}:{image_hash}"
+
+# Gemini emits object keys in alphabetical order, so the top-level keys are named for the order they should
+# stream in: what to do first, then the follow-up plan, then the prose
+STREAMED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "action": {
+            "type": "object",
+            "properties": {
+                "next_action": {"type": "string", "enum": ["click", "type", "scroll", "navigate", "wait", "done"]},
+                "target_element": {"type": "string"},
+                "input_text": {"type": "string"},
+                "submit": {"type": "boolean"},
+                "scroll_direction": {"type": "string", "enum": ["up", "down"]},
+                "target_url": {"type": "string"},
+                "evidence": {"type": "string"},
+                "confidence": {"type": "integer"}
+            },
+            "required": ["next_action", "confidence"]
+        },
+        "followup": {
+            "type": "object",
+            "properties": {
+                "plan": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "action": {"type": "string", "enum": ["click", "type", "scroll", "navigate", "wait"]},
+                            "target_element": {"type": "string"},
+                            "input_text": {"type": "string"},
+                            "submit": {"type": "boolean"},
+                            "scroll_direction": {"type": "string", "enum": ["up", "down"]},
+                            "precondition": {
+                                "type": "object",
+                                "properties": {
+                                    "url_contains": {"type": "string"},
+                                    "element_present": {"type": "string"}
+                                }
+                            }
+                        },
+                        "required": ["action"]
+                    }
+                },
+                "alternative_actions": {"type": "array", "items": {"type": "string"}}
+            }
+        },
+        "notes": {
+            "type": "object",
+            "properties": {
+                "task_progress": {"type": "string"},
+                "reasoning": {"type": "string"},
+                "analysis": {"type": "string"}
+            }
+        }
+    },
+    "required": ["action", "followup", "notes"]
+}
+
+class StreamingJsonParser:
+    """Incremental parser for a JSON object that arrives in chunks.
+    feed() returns the (path, value) pairs completed by the chunk, for object keys up to max_depth levels deep
+    and not inside arrays, e.g. (("action",), {...}) or (("notes", "reasoning"), "...")."""
+    def __init__(self, max_depth: int = 2):
+        self.max_depth = max_depth
+        self.buffer = ""
+        self._scanned = 0
+        # One frame per open container: [opening bracket, current key, start of the current value]
+        self._stack: List[list] = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_string = ""
+    
+    def feed(self, chunk: str) -> List[Tuple[Tuple[str, ...], object]]:
+        self.buffer += chunk
+        completed = []
+        buffer = self.buffer
+        for index in range(self._scanned, len(buffer)):
+            char = buffer[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = buffer[self._string_start:index + 1]
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = index
+            elif char in '{[':
+                self._stack.append([char, None, None])
+            elif char == ':' and self._stack:
+                frame = self._stack[-1]
+                frame[1] = json.loads(self._last_string)
+                frame[2] = index + 1
+            elif char in ',}]' and self._stack:
+                frame = self._stack[-1]
+                if frame[0] == '{' and frame[2] is not None:
+                    self._complete(buffer[frame[2]:index], completed)
+                    frame[2] = None
+                if char != ',':
+                    self._stack.pop()
+        self._scanned = len(buffer)
+        return completed
+    
+    def _complete(self, text: str, completed: List):
+        if len(self._stack) > self.max_depth or any(frame[0] != '{' for frame in self._stack):
+            return
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            return
+        completed.append((tuple(frame[1] for frame in self._stack), value))
+    
+    def result(self) -> Dict:
+        """The whole object; raises json.JSONDecodeError if the stream was cut short or malformed"""
+        return json.loads(self.buffer)
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, shared by every agent in the process.
+    Waiting calls are granted lowest priority value first, then in arrival order. A throttled call pauses
+    everyone until the server's retry hint (or an exponential backoff with jitter) has passed."""
+    _shared: Optional["RateLimiter"] = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, requests_per_minute: float = 60, tokens_per_minute: float = 1_000_000, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        if max_retries < 1:
+            raise ValueError(f"max_retries must allow at least one attempt, got {max_retries}")
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._waiting: List[Tuple[float, int]] = []
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        
+        self._started = time.monotonic()
+        self.calls = 0
+        self.failed_calls = 0
+        self.retries = 0
+        self.throttle_events = 0
+        self.backoff_total = 0.0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+    
+    @classmethod
+    def shared(cls) -> "RateLimiter":
+        """The process-wide limiter, sized from GEMINI_RPM and GEMINI_TPM when set"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(
+                    requests_per_minute=float(os.getenv("GEMINI_RPM", 60)),
+                    tokens_per_minute=float(os.getenv("GEMINI_TPM", 1_000_000))
+                )
+            return cls._shared
+    
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+    
+    async def acquire(self, tokens: int, priority: float = 0.0) -> float:
+        """Wait for a request slot and tokens; returns the seconds spent waiting"""
+        entry = (priority, next(self._sequence))
+        # A single call larger than the whole bucket still goes through once the bucket is full
+        tokens = min(tokens, self.tokens_per_minute)
+        start = time.monotonic()
+        with self._lock:
+            heapq.heappush(self._waiting, entry)
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = 0.02
+                    if self._waiting[0] == entry:
+                        if now < self._paused_until:
+                            delay = self._paused_until - now
+                        elif self._requests >= 1 and self._tokens >= tokens:
+                            self._requests -= 1
+                            self._tokens -= tokens
+                            heapq.heappop(self._waiting)
+                            waited = now - start
+                            self.calls += 1
+                            self.queue_wait_total += waited
+                            self.queue_wait_max = max(self.queue_wait_max, waited)
+                            return waited
+                        else:
+                            delay = max((1 - self._requests) * 60 / self.requests_per_minute,
+                                        (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                await asyncio.sleep(min(max(delay, 0.005), 1.0))
+        except BaseException:
+            with self._lock:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+            raise
+    
+    def settle(self, reserved: int, used: int):
+        """Correct the token bucket once the real usage of a call is known"""
+        with self._lock:
+            self._tokens = min(self.tokens_per_minute, self._tokens + reserved - used)
+    
+    @staticmethod
+    def _is_throttle(error: Exception) -> bool:
+        message = str(error).lower()
+        return (getattr(error, "code", None) == 429 or type(error).__name__ == "ResourceExhausted"
+                or "429" in message or "quota" in message or "rate limit" in message)
+    
+    @staticmethod
+    def _retry_hint(error: Exception) -> Optional[float]:
+        message = str(error)
+        match = (re.search(r"retry in ([\d.]+)\s*s", message, re.IGNORECASE)
+                 or re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", message))
+        return float(match.group(1)) if match else None
+    
+    def record_failure(self):
+        """Count a granted call that failed, so calls only counts the ones that succeeded"""
+        with self._lock:
+            self.failed_calls += 1
+    
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Seconds to wait before retrying attempt; throttling errors pause every caller for that long.
+        The caller sleeps outside acquire(), so the delay is recorded here as backoff time rather than queue wait."""
+        hint = self._retry_hint(error)
+        if hint is not None:
+            delay = hint + random.uniform(0, self.base_delay)
+        else:
+            ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+            delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        with self._lock:
+            self.retries += 1
+            self.backoff_total += delay
+            if self._is_throttle(error):
+                self.throttle_events += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+    
+    def metrics(self) -> Dict:
+        elapsed = time.monotonic() - self._started
+        succeeded = self.calls - self.failed_calls
+        return {
+            "calls": succeeded,
+            "failed_calls": self.failed_calls,
+            "retries": self.retries,
+            "throttle_events": self.throttle_events,
+            "backoff_s": round(self.backoff_total, 2),
+            "queue_depth": len(self._waiting),
+            "mean_queue_wait_ms": round(self.queue_wait_total / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_queue_wait_ms": round(self.queue_wait_max * 1000, 1),
+            "calls_per_second": round(succeeded / elapsed, 3) if elapsed else 0.0
+        }
+
+class DecisionCache:
+    """LRU cache of model decisions keyed on (task, page fingerprint).
+    Entries older than ttl seconds are ignored; path enables persistence across runs."""
+    def __init__(self, max_entries: int = 256, ttl: Optional[float] = None, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        
+        if path and os.path.exists(path):
+            self.load()
+    
+    @staticmethod
+    def _key(task: str, fingerprint: str) -> str:
+        return hashlib.sha1(f"{task}\0{fingerprint}".encode('utf-8')).hexdigest()
+    
+    def get(self, task: str, fingerprint: str) -> Optional[Dict]:
+        key = self._key(task, fingerprint)
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.time() - entry['created'] > self.ttl:
+            del self._entries[key]
+            entry = None
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry['decision'])
+    
+    def put(self, task: str, fingerprint: str, decision: Dict):
+        key = self._key(task, fingerprint)
+        self._entries[key] = {"task": task, "fingerprint": fingerprint, "decision": decision, "created": time.time()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, task: Optional[str] = None, fingerprint: Optional[str] = None):
+        """Drop entries matching task and/or fingerprint; with no arguments, drop everything"""
+        for key, entry in list(self._entries.items()):
+            if (task is None or entry['task'] == task) and (fingerprint is None or entry['fingerprint'] == fingerprint):
+                del self._entries[key]
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+    
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+            self._entries = OrderedDict((self._key(e['task'], e['fingerprint']), e) for e in entries)
+        except Exception as e:
+            print(f"Could not load decision cache from {self.path}: {e}")
+    
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self._entries.values()), f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Could not save decision cache to {self.path}: {e}")
+
+# Counts in-flight fetch/XHR requests. Registered for every new document via CDP
+# where available and installed on demand otherwise.
+NETWORK_HOOKS_JS = """
+    (function () {
+        if (window.__agentNetwork) {
+            return;
+        }
+        var network = window.__agentNetwork = {inflight: 0, lastActivity: performance.now()};
+        function started() {
+            network.inflight++;
+            network.lastActivity = performance.now();
+        }
+        function finished() {
+            network.inflight = Math.max(0, network.inflight - 1);
+            network.lastActivity = performance.now();
+        }
+        if (window.fetch) {
+            var originalFetch = window.fetch;
+            window.fetch = function () {
+                started();
+                return originalFetch.apply(this, arguments).then(function (response) {
+                    finished();
+                    return response;
+                }, function (error) {
+                    finished();
+                    throw error;
+                });
+            };
+        }
+        var originalSend = XMLHttpRequest.prototype.send;
+        XMLHttpRequest.prototype.send = function () {
+            started();
+            this.addEventListener('loadend', finished, {once: true});
+            return originalSend.apply(this, arguments);
+        };
+    })();
+"""
+
+# Resolves once the document is complete, no fetch/XHR has been in flight and the
+# DOM has not mutated for quietMs, and no finite animation is running; or when
+# timeoutMs elapses. Reports how long it waited and which signals were pending.
+WAIT_FOR_READY_SCRIPT = NETWORK_HOOKS_JS + """
+    var timeoutMs = arguments[0], quietMs = arguments[1], done = arguments[arguments.length - 1];
+    var start = performance.now();
+    var lastMutation = start;
+    var observer = new MutationObserver(function () { lastMutation = performance.now(); });
+    observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    
+    function runningAnimations() {
+        if (!document.getAnimations) {
+            return 0;
+        }
+        return document.getAnimations().filter(function (animation) {
+            var timing = animation.effect && animation.effect.getComputedTiming ? animation.effect.getComputedTiming() : null;
+            return animation.playState === 'running' && !(timing && timing.iterations === Infinity);
+        }).length;
+    }
+    
+    function check() {
+        var now = performance.now();
+        var network = window.__agentNetwork;
+        var signals = {
+            document: document.readyState === 'complete',
+            network: network.inflight === 0 && now - network.lastActivity >= quietMs,
+            dom: now - lastMutation >= quietMs,
+            animations: runningAnimations() === 0
+        };
+        var pending = Object.keys(signals).filter(function (name) { return !signals[name]; });
+        if (pending.length === 0 || now - start >= timeoutMs) {
+            observer.disconnect();
+            done({ready: pending.length === 0, waited_ms: now - start, pending: pending});
+            return;
+        }
+        setTimeout(check, 25);
+    }
+    check();
+"""
+
+# Errors from execute_async_script that mean the page navigated away mid-wait, not that the session broke
+NAVIGATION_ERROR_MARKERS = ("document unloaded", "navigated or closed", "execution context was destroyed")
+
+# Bounds for a "wait" action's wait_time, which comes from the model as any JSON value
+DEFAULT_WAIT_S = 2.0
+MAX_WAIT_S = 10.0
+
+def wait_seconds(value) -> float:
+    """wait_time as seconds within [0, MAX_WAIT_S]; DEFAULT_WAIT_S for anything that is not a finite number"""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return DEFAULT_WAIT_S
+    if seconds != seconds or seconds in (float("inf"), float("-inf")):
+        return DEFAULT_WAIT_S
+    return min(max(seconds, 0.0), MAX_WAIT_S)
+
+@dataclass
+class ReadinessConfig:
+    """Upper bounds (seconds) for the readiness wait after each kind of action"""
+    quiet_ms: int = 100
+    timeouts: Dict[str, float] = field(default_factory=lambda: {
+        "navigate": 10.0, "click": 5.0, "type": 1.0, "scroll": 1.0, "step": 2.0
+    })
+    default_timeout: float = 2.0
+
+# Network.setBlockedURLs only matches URLs, so resource types are blocked by file extension
+RESOURCE_TYPE_PATTERNS = {
+    "Image": ["*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.avif*", "*.svg*", "*.ico*"],
+    "Media": ["*.mp4*", "*.webm*", "*.m4s*", "*.m3u8*", "*.mp3*", "*.ogg*"],
+    "Font": ["*.woff*", "*.ttf*", "*.otf*", "*.eot*"],
+    "Stylesheet": ["*.css*"],
+}
+
+# Third-party analytics, ad and session-recording scripts that never matter to the agent
+TRACKER_PATTERNS = [
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*googlesyndication.com*",
+    "*googleadservices.com*", "*amazon-adsystem.com*", "*facebook.net*", "*connect.facebook.com*",
+    "*hotjar.com*", "*clarity.ms*", "*segment.io*", "*cdn.segment.com*", "*mixpanel.com*",
+    "*scorecardresearch.com*", "*adnxs.com*", "*criteo.com*", "*taboola.com*", "*outbrain.com*",
+    "*nr-data.net*", "*optimizely.com*", "*bat.bing.com*"
+]
+
+# Holds back <script src> elements that page code inserts from other sites (tag managers, chat widgets,
+# A/B testing loaders) until the load event, then inserts them in order. Parser-inserted scripts and
+# same-site scripts are untouched, so the page still works; it just reaches load without waiting for them.
+DEFER_THIRD_PARTY_SCRIPTS_JS = """
+    (function () {
+        if (window.__agentDeferredScripts !== undefined) {
+            return;
+        }
+        window.__agentDeferredScripts = 0;
+        var site = location.hostname.split('.').slice(-2).join('.');
+        var pending = [], loaded = false;
+        var append = Node.prototype.appendChild, insertBefore = Node.prototype.insertBefore;
+        
+        function thirdParty(node) {
+            if (loaded || !node || node.nodeName !== 'SCRIPT' || !node.src) {
+                return false;
+            }
+            var host = new URL(node.src, location.href).hostname;
+            return host !== '' && host !== site && host.slice(-site.length - 1) !== '.' + site;
+        }
+        
+        Node.prototype.appendChild = function (node) {
+            if (thirdParty(node)) {
+                pending.push([this, node, null]);
+                window.__agentDeferredScripts++;
+                return node;
+            }
+            return append.call(this, node);
+        };
+        Node.prototype.insertBefore = function (node, reference) {
+            if (thirdParty(node)) {
+                pending.push([this, node, reference]);
+                window.__agentDeferredScripts++;
+                return node;
+            }
+            return insertBefore.call(this, node, reference);
+        };
+        
+        window.addEventListener('load', function () {
+            loaded = true;
+            setTimeout(function () {
+                pending.forEach(function (entry) {
+                    var parent = entry[0], node = entry[1], reference = entry[2];
+                    insertBefore.call(parent, node, reference && reference.parentNode === parent ? reference : null);
+                });
+                pending = [];
+            }, 0);
+        });
+    })();
+"""
+
+@dataclass
+class LoadProfile:
+    """What to skip while pages load. block_types are resource types from RESOURCE_TYPE_PATTERNS,
+    block_patterns are extra Network.setBlockedURLs wildcards and block_trackers adds TRACKER_PATTERNS.
+    image_placeholders launches Chrome with images disabled, which keeps their boxes but never fetches them.
+    defer_third_party_scripts holds scripts that page code inserts from other sites until the load event."""
+    name: str = "full"
+    block_types: List[str] = field(default_factory=list)
+    block_patterns: List[str] = field(default_factory=list)
+    block_trackers: bool = False
+    image_placeholders: bool = False
+    defer_third_party_scripts: bool = False
+    
+    def blocked_urls(self) -> List[str]:
+        urls = []
+        for resource_type in self.block_types:
+            if resource_type not in RESOURCE_TYPE_PATTERNS:
+                raise ValueError(f"Unknown resource type: {resource_type}")
+            urls.extend(RESOURCE_TYPE_PATTERNS[resource_type])
+        if self.image_placeholders and "Image" not in self.block_types:
+            # Covers drivers that were launched with images enabled
+            urls.extend(RESOURCE_TYPE_PATTERNS["Image"])
+        if self.block_trackers:
+            urls.extend(TRACKER_PATTERNS)
+        return urls + list(self.block_patterns)
+
+LOAD_PROFILES = {
+    "full": LoadProfile(name="full"),
+    "lean": LoadProfile(name="lean", block_types=["Media", "Font"], block_trackers=True, defer_third_party_scripts=True),
+    "minimal": LoadProfile(name="minimal", block_types=["Media", "Font"], block_trackers=True, image_placeholders=True,
+                           defer_third_party_scripts=True),
+}
+
+def needs_performance_log(*profiles: LoadProfile) -> bool:
+    """The DevTools performance log buffers every network event until it is read, so it is only worth
+    turning on when a profile blocks requests that should be counted"""
+    return any(profile.blocked_urls() for profile in profiles)
+
+def resolve_load_profile(profile: Union[str, LoadProfile]) -> LoadProfile:
+    if isinstance(profile, LoadProfile):
+        return profile
+    if profile not in LOAD_PROFILES:
+        raise ValueError(f"Unknown load profile: {profile}")
+    return LOAD_PROFILES[profile]
+
+NAVIGATION_TIMING_SCRIPT = """
+    var navigation = performance.getEntriesByType('navigation')[0];
+    var resources = performance.getEntriesByType('resource');
+    var transferred = navigation ? navigation.transferSize : 0;
+    for (var i = 0; i < resources.length; i++) {
+        transferred += resources[i].transferSize;
+    }
+    return {
+        dom_content_loaded_ms: navigation ? Math.round(navigation.domContentLoadedEventEnd) : null,
+        load_event_ms: navigation ? Math.round(navigation.loadEventEnd) : null,
+        requests: resources.length + 1,
+        transferred_bytes: transferred,
+        deferred_scripts: window.__agentDeferredScripts || 0
+    };
+"""
+
+class TrajectoryStore:
+    """Successful action sequences keyed by (start URL, task), one JSON file per key in directory"""
+    def __init__(self, directory: str = "trajectories"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, url: str, task: str) -> str:
+        key = hashlib.sha1(f"{url}\0{task}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+    
+    def load(self, url: str, task: str) -> Optional[Dict]:
+        """The stored record: "steps" and the "evidence" that verified the task (None in older files)"""
+        path = self._path(url, task)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                record = json.load(f)
+            return {"steps": record["steps"], "evidence": record.get("evidence")}
+        except Exception as e:
+            print(f"Could not load trajectory {path}: {e}")
+            return None
+    
+    def save(self, url: str, task: str, steps: List[Dict], evidence: Optional[str] = None):
+        # Write a private temp file and swap it in, so concurrent saves and crashes never leave a partial file
+        path = self._path(url, task)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"url": url, "task": task, "updated": time.time(), "steps": steps, "evidence": evidence}, f, indent=2)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Could not save trajectory {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def delete(self, url: str, task: str):
+        path = self._path(url, task)
+        if os.path.exists(path):
+            os.remove(path)
+
+# Shorter evidence ("a", "search") is found on nearly every page
+MIN_EVIDENCE_CHARS = 8
+
+VERIFY_EVIDENCE_SCRIPT = """
+    function normalize(text) {
+        return (text || '').replace(/\\s+/g, ' ').trim().toLowerCase();
+    }
+    var evidence = normalize(arguments[0]);
+    if (!evidence) {
+        return null;
+    }
+    if (normalize(document.title).indexOf(evidence) !== -1) {
+        return 'title';
+    }
+    if (window.location.href.toLowerCase().indexOf(evidence) !== -1) {
+        return 'url';
+    }
+    if (document.body && normalize(document.body.innerText).indexOf(evidence) !== -1) {
+        return 'page text';
+    }
+    return null;
+"""
+
+@dataclass
+class TaskResult:
+    """Outcome of perform_task. reason is "done", "replayed", "loop", "stalled", "max_steps" or "navigation_failed"."""
+    success: bool
+    reason: str
+    steps: int
+    llm_calls: int = 0
+    final_url: str = ""
+    evidence: Optional[str] = None
+    wall_time_s: float = 0.0
+    modality: Dict = field(default_factory=dict)
+    first_step_s: Optional[float] = None
+    
+    def __bool__(self) -> bool:
+        return self.success
+    
+    def to_dict(self) -> Dict:
+        return {
+            "success": self.success,
+            "reason": self.reason,
+            "steps": self.steps,
+            "llm_calls": self.llm_calls,
+            "final_url": self.final_url,
+            "evidence": self.evidence,
+            "wall_time_s": self.wall_time_s,
+            "modality": self.modality,
+            "first_step_s": self.first_step_s
+        }
+
+class ProgressMonitor:
+    """Counts (page state, action) pairs and consecutive failed steps within one task.
+    A limit of 0 disables that check."""
+    def __init__(self, max_repeats: int = 3, max_failures: int = 3):
+        self.max_repeats = max_repeats
+        self.max_failures = max_failures
+        self.failures = 0
+        self._seen: Dict[Tuple[str, str], int] = {}
+    
+    @staticmethod
+    def action_key(action_data: Dict) -> str:
+        fields = ("next_action", "target_element", "input_text", "scroll_direction", "target_url", "evidence")
+        return json.dumps([action_data.get(name) for name in fields])
+    
+    def propose(self, state: str, action_data: Dict) -> int:
+        """Record that action_data was proposed on state; returns how many times it was proposed before"""
+        key = (state, self.action_key(action_data))
+        repeats = self._seen.get(key, 0)
+        self._seen[key] = repeats + 1
+        return repeats
+    
+    def record(self, success: bool):
+        self.failures = 0 if success else self.failures + 1
+    
+    def stop_reason(self, repeats: int) -> Optional[str]:
+        if self.max_repeats and repeats + 1 >= self.max_repeats:
+            return "loop"
+        if self.max_failures and self.failures >= self.max_failures:
+            return "stalled"
+        return None
+
+class RunRecorder:
+    """Encodes the agent's step screenshots into an MP4 or GIF (by path suffix) while the task runs.
+    Frames go through a bounded queue to a background thread that draws the action overlay and pipes raw
+    frames to ffmpeg, so nothing is buffered beyond max_queue frames and a full queue drops the frame
+    instead of blocking the agent."""
+    def __init__(self, path: str, fps: float = 1.0, max_width: int = 1280, max_queue: int = 8):
+        suffix = os.path.splitext(path)[1].lower()
+        if suffix not in (".mp4", ".gif"):
+            raise ValueError(f"Recordings must be .mp4 or .gif, not {path}")
+        self.path = path
+        self.fps = fps
+        self.max_width = max_width
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._gif = suffix == ".gif"
+        self._size: Optional[Tuple[int, int]] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        
+        if shutil.which("ffmpeg") is None:
+            print("ffmpeg not found, recording disabled")
+            self._closed = True
+        else:
+            self._thread = threading.Thread(target=self._run, name="run-recorder", daemon=True)
+            self._thread.start()
+    
+    def add_frame(self, image_data: bytes, overlay: Optional[Dict] = None):
+        """Queue an encoded screenshot. overlay may hold "box" (x, y, w, h in image pixels) and "label"."""
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait((image_data, overlay or {}))
+        except queue.Full:
+            self.frames_dropped += 1
+    
+    def _ffmpeg_command(self, width: int, height: int) -> List[str]:
+        command = [
+            "ffmpeg", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-framerate", str(self.fps), "-i", "-"
+        ]
+        if self._gif:
+            # A palette per frame keeps memory flat; a global palette would need every frame first
+            command += ["-vf", "split[s0][s1];[s0]palettegen=stats_mode=single[p];[s1][p]paletteuse=new=1"]
+        else:
+            command += ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+        return command + [self.path]
+    
+    def _render(self, image_data: bytes, overlay: Dict) -> "Image.Image":
+        image = Image.open(BytesIO(image_data)).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        box = overlay.get("box")
+        if box:
+            x, y, width, height = box
+            draw.rectangle([x, y, x + width, y + height], outline=(255, 0, 0), width=3)
+        label = overlay.get("label")
+        if label:
+            text_box = draw.textbbox((8, 8), label)
+            draw.rectangle([text_box[0] - 4, text_box[1] - 4, text_box[2] + 4, text_box[3] + 4], fill=(0, 0, 0))
+            draw.text((8, 8), label, fill=(255, 255, 255))
+        
+        if self._size is None:
+            scale = min(1.0, self.max_width / image.width)
+            # yuv420p needs even dimensions
+            self._size = (int(image.width * scale) // 2 * 2, int(image.height * scale) // 2 * 2)
+        if image.size != self._size:
+            image = image.resize(self._size)
+        return image
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                frame = self._render(*item)
+                if self._process is None:
+                    self._process = subprocess.Popen(self._ffmpeg_command(*self._size), stdin=subprocess.PIPE)
+                self._process.stdin.write(frame.tobytes())
+                self.frames_written += 1
+            except Exception as e:
+                print(f"Recorder dropped a frame: {e}")
+                self.frames_dropped += 1
+    
+    def close(self):
+        """Flush queued frames and finish the file"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            print(f"Recording saved to {self.path}: {self.frames_written} frames, {self.frames_dropped} dropped")
+
+class ElementRegistry:
+    """Live WebElement references of the last extracted elements, keyed by element handle (two elements can
+    share an XPath such as //*[@id="x"]), so actions use the stored reference and only locate the element
+    again when it has gone stale"""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._elements: Dict[int, object] = {}
+    
+    def get(self, handle: Optional[int]):
+        element = self._elements.get(handle) if handle is not None else None
+        if element is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return element
+    
+    def register(self, handle: Optional[int], element):
+        if handle is not None and element is not None:
+            self._elements[handle] = element
+    
+    def discard(self, handle: Optional[int], stale: bool = False):
+        if self._elements.pop(handle, None) is not None and stale:
+            self.stale += 1
+    
+    def clear(self):
+        self._elements = {}
+    
+    def stats(self) -> Dict:
+        return {"size": len(self._elements), "hits": self.hits, "misses": self.misses, "stale": self.stale}
+
+# Python mirror of ELEMENT_CSS_SELECTOR, applied to DOMSnapshot nodes
+CDP_CANDIDATE_TAGS = {'button', 'input', 'select', 'textarea', 'form'}
+CDP_LINK_PARENTS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'p', 'span'}
+CDP_WIDGET_ROLES = {'button', 'link', 'tab', 'menuitem'}
+
+# Same terms and weights as rankElements in COLLECT_ELEMENTS_JS
+RANK_STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'to', 'of', 'on', 'in', 'into', 'for', 'with', 'then', 'it', 'is', 'go',
+    'click', 'press', 'type', 'enter', 'find', 'open', 'please', 'page', 'website', 'site'
+}
+RANK_NATIVE_CONTROLS = {'a', 'button', 'input', 'select', 'textarea'}
+RANK_ROLE_WEIGHTS = {
+    'input': 0.8, 'textarea': 0.8, 'select': 0.7, 'button': 0.5, 'a': 0.3,
+    'div': 0.2, 'span': 0.2, 'label': 0.1, 'form': 0
+}
+
+def task_terms(task: str) -> List[str]:
+    terms = []
+    for term in re.findall(r'[a-z0-9]+', task.lower()):
+        if len(term) >= 2 and term not in RANK_STOPWORDS and term not in terms:
+            terms.append(term)
+    return terms
+
+def words_of(text: str) -> Set[str]:
+    """Words of text, so task terms match whole words ("ai" does not match "mail")"""
+    return set(re.findall(r'[a-z0-9]+', text))
+
+class CdpTransport:
+    """Chrome DevTools Protocol fast path: Page.captureScreenshot with clip and scale, one
+    DOMSnapshot.captureSnapshot for the element list, and Input events for clicks and typing.
+    Methods raise on any failure so the caller can fall back to WebDriver."""
+    SNAPSHOT_STYLES = ["visibility", "opacity"]
+    
+    def __init__(self, driver):
+        self.driver = driver
+        self._nodes: Dict[str, int] = {}
+    
+    def command(self, cmd: str, params: Optional[Dict] = None) -> Dict:
+        return self.driver.execute_cdp_cmd(cmd, params or {})
+    
+    def knows(self, xpath: str) -> bool:
+        return xpath in self._nodes
+    
+    def forget(self):
+        self._nodes = {}
+    
+    def capture_screenshot(self, config: ScreenshotConfig, clip: Optional[Tuple[float, float, float, float]] = None) -> Tuple[bytes, str, int, int]:
+        """Viewport (or clip, in page coordinates) scaled down by Chrome to fit config. Returns (data, mime_type, width, height)"""
+        if config.format not in SCREENSHOT_FORMATS:
+            raise ValueError(f"Unknown screenshot format: {config.format}")
+        metrics = self.command("Page.getLayoutMetrics")
+        viewport = metrics.get("cssVisualViewport") or metrics["visualViewport"]
+        device_scale = metrics["visualViewport"]["clientWidth"] / viewport["clientWidth"] if "cssVisualViewport" in metrics else 1.0
+        if clip is None:
+            clip = (viewport["pageX"], viewport["pageY"], viewport["clientWidth"], viewport["clientHeight"])
+        x, y, width, height = clip
+        scale = min(1.0, config.max_width / (width * device_scale), config.max_height / (height * device_scale))
+        
+        # Grayscale still needs PIL, so ask for a lossless capture and convert that
+        capture_format = "png" if config.grayscale else config.format
+        params = {"format": capture_format, "clip": {"x": x, "y": y, "width": width, "height": height, "scale": scale}}
+        if capture_format != "png":
+            params["quality"] = config.quality
+        data = base64.b64decode(self.command("Page.captureScreenshot", params)["data"])
+        if config.grayscale:
+            return encode_screenshot(data, config)
+        image_width, image_height = Image.open(BytesIO(data)).size
+        return data, SCREENSHOT_FORMATS[config.format][1], image_width, image_height
+    
+    def snapshot_elements(self, max_elements: int, rank_task: Optional[str] = None) -> List[ElementInfo]:
+        """The same candidates as the extraction script, built from a single DOMSnapshot.captureSnapshot"""
+        snapshot = self.command("DOMSnapshot.captureSnapshot", {"computedStyles": self.SNAPSHOT_STYLES, "includeDOMRects": True})
+        strings = snapshot["strings"]
+        document = snapshot["documents"][0]
+        nodes, layout = document["nodes"], document["layout"]
+        
+        def string(index: int) -> str:
+            return strings[index] if index >= 0 else ""
+        
+        names = [string(index).lower() for index in nodes["nodeName"]]
+        types = nodes["nodeType"]
+        parents = nodes["parentIndex"]
+        values = nodes.get("nodeValue") or [-1] * len(names)
+        backend_ids = nodes["backendNodeId"]
+        input_values = dict(zip(nodes.get("inputValue", {}).get("index", []), nodes.get("inputValue", {}).get("value", [])))
+        document_url = string(document.get("documentURL", -1))
+        
+        attribute_cache: Dict[int, Dict[str, str]] = {}
+        def attributes_of(index: int) -> Dict[str, str]:
+            if index not in attribute_cache:
+                flat = nodes["attributes"][index]
+                attribute_cache[index] = {string(flat[k]).lower(): string(flat[k + 1]) for k in range(0, len(flat), 2)}
+            return attribute_cache[index]
+        
+        children: List[List[int]] = [[] for _ in names]
+        positions = [0] * len(names)
+        sibling_counts: Dict[Tuple[int, str], int] = {}
+        for index, parent in enumerate(parents):
+            if parent < 0:
+                continue
+            children[parent].append(index)
+            if types[index] == 1:
+                key = (parent, names[index])
+                sibling_counts[key] = sibling_counts.get(key, 0) + 1
+                positions[index] = sibling_counts[key]
+        
+        text_cache: Dict[int, str] = {}
+        def text_of(index: int) -> str:
+            if index not in text_cache:
+                parts, stack = [], [index]
+                while stack:
+                    current = stack.pop()
+                    if types[current] == 3:
+                        parts.append(string(values[current]))
+                    elif names[current] not in ('script', 'style'):
+                        stack.extend(reversed(children[current]))
+                text_cache[index] = " ".join(" ".join(parts).split())
+            return text_cache[index]
+        
+        def xpath_of(index: int) -> str:
+            parts = []
+            while index >= 0 and types[index] == 1:
+                element_id = attributes_of(index).get('id')
+                if element_id:
+                    return f'//*[@id="{element_id}"]' + "".join(reversed(parts))
+                if names[index] == 'body':
+                    return '/html/body' + "".join(reversed(parts))
+                parts.append(f"/{names[index]}[{positions[index]}]")
+                index = parents[index]
+            return ""
+        
+        def is_candidate(index: int) -> bool:
+            name, attributes = names[index], attributes_of(index)
+            if name in CDP_CANDIDATE_TAGS:
+                return True
+            if name == 'a':
+                return 'href' in attributes or (parents[index] >= 0 and names[parents[index]] in CDP_LINK_PARENTS)
+            if name in ('div', 'span'):
+                return ('onclick' in attributes or 'tabindex' in attributes
+                        or (name == 'div' and attributes.get('role') in CDP_WIDGET_ROLES))
+            return name == 'label' and 'for' in attributes
+        
+        candidates = []
+        seen = set()
+        for position, index in enumerate(layout["nodeIndex"]):
+            if index in seen or types[index] != 1 or not is_candidate(index):
+                continue
+            seen.add(index)
+            x, y, width, height = layout["bounds"][position]
+            visibility, opacity = (string(value) for value in layout["styles"][position])
+            if width == 0 or height == 0 or visibility == 'hidden' or opacity == '0':
+                continue
+            candidates.append((index, (x, y, width, height)))
+        candidates.sort()
+        
+        if rank_task is not None:
+            candidates = self._rank(candidates, rank_task, names, parents, attributes_of, text_of, document)
+        candidates = candidates[:max_elements]
+        
+        self._nodes = {}
+        elements = []
+        for index, rect in candidates:
+            xpath = xpath_of(index)
+            if not xpath:
+                continue
+            attributes = {}
+            for name in ELEMENT_ATTRIBUTES:
+                value = attributes_of(index).get(name)
+                if name == 'value' and index in input_values:
+                    value = string(input_values[index])
+                elif name == 'href' and value:
+                    value = urljoin(document_url, value)
+                if value:
+                    attributes[name] = value[:100]
+            elements.append(ElementInfo(
+                tag=names[index],
+                text=text_of(index)[:100],
+                xpath=xpath,
+                attributes=attributes,
+                coordinates=rect,
+                element_id=f"{names[index]}_{index}"
+            ))
+            self._nodes[xpath] = backend_ids[index]
+        return elements
+    
+    def _rank(self, candidates: List, task: str, names: List[str], parents: List[int], attributes_of, text_of, document: Dict) -> List:
+        """Port of rankElements: drop nested duplicates, then order by task relevance, viewport, size and role"""
+        viewport = self.command("Page.getLayoutMetrics").get("cssLayoutViewport", {})
+        scroll_x, scroll_y = document.get("scrollOffsetX", 0), document.get("scrollOffsetY", 0)
+        viewport_width, viewport_height = viewport.get("clientWidth", 0), viewport.get("clientHeight", 0)
+        terms = task_terms(task)
+        
+        indexes = {index for index, _ in candidates}
+        redundant = set()
+        for index, _ in candidates:
+            ancestor = parents[index]
+            for _ in range(3):
+                if ancestor < 0:
+                    break
+                if ancestor in indexes and text_of(ancestor).lower()[:300] == text_of(index).lower()[:300]:
+                    redundant.add(index if names[ancestor] in RANK_NATIVE_CONTROLS else ancestor)
+                ancestor = parents[ancestor]
+        
+        scored = []
+        for order, (index, rect) in enumerate(candidates):
+            if index in redundant:
+                continue
+            attributes = attributes_of(index)
+            fields = [
+                (words_of(text_of(index).lower()[:300]), 1.0),
+                (words_of(attributes.get('aria-label', '').lower()), 1.0),
+                (words_of(attributes.get('placeholder', '').lower()), 1.2),
+                (words_of(attributes.get('title', '').lower()), 0.8),
+                (words_of(attributes.get('name', '').lower()), 0.5)
+            ]
+            lexical = sum(max([weight for words, weight in fields if term in words] or [0]) for term in terms)
+            if terms:
+                lexical /= len(terms)
+            
+            x, y, width, height = rect
+            in_viewport = (y + height > scroll_y and x + width > scroll_x
+                           and y < scroll_y + viewport_height and x < scroll_x + viewport_width)
+            size = min(1.0, width * height / 20000)
+            role = 0.5 if attributes.get('role') else RANK_ROLE_WEIGHTS.get(names[index], 0.2)
+            score = 3 * lexical + (1 if in_viewport else 0) + 0.5 * size + role
+            scored.append((-score, order, index, rect))
+        scored.sort()
+        return [(index, rect) for _, _, index, rect in scored]
+    
+    def _resolve(self, xpath: str) -> int:
+        if xpath not in self._nodes:
+            raise KeyError(f"{xpath} is not in the last DOM snapshot")
+        return self._nodes[xpath]
+    
+    def click(self, xpath: str):
+        """Scroll the element into view and send a real mouse click at the centre of its first content quad,
+        after checking that the element (or one of its descendants) is what is on top at that point"""
+        backend_id = self._resolve(xpath)
+        self.command("DOM.scrollIntoViewIfNeeded", {"backendNodeId": backend_id})
+        quads = self.command("DOM.getContentQuads", {"backendNodeId": backend_id})["quads"]
+        if not quads:
+            raise ValueError(f"{xpath} has no layout box")
+        x = sum(quads[0][0::2]) / 4
+        y = sum(quads[0][1::2]) / 4
+        self._hit_test(backend_id, xpath, x, y)
+        self.command("Input.dispatchMouseEvent", {"type": "mouseMoved", "x": x, "y": y})
+        self.command("Input.dispatchMouseEvent", {"type": "mousePressed", "x": x, "y": y, "button": "left", "clickCount": 1})
+        self.command("Input.dispatchMouseEvent", {"type": "mouseReleased", "x": x, "y": y, "button": "left", "clickCount": 1})
+    
+    def _hit_test(self, backend_id: int, xpath: str, x: float, y: float):
+        """Raise if an overlay, banner or another element would receive a click at (x, y)"""
+        hit_id = self.command("DOM.getNodeForLocation", {"x": int(x), "y": int(y), "ignorePointerEventsNone": True})["backendNodeId"]
+        if hit_id == backend_id:
+            return
+        target = self.command("DOM.resolveNode", {"backendNodeId": backend_id})["object"]["objectId"]
+        hit = self.command("DOM.resolveNode", {"backendNodeId": hit_id})["object"]["objectId"]
+        inside = self.command("Runtime.callFunctionOn", {
+            "objectId": target,
+            "functionDeclaration": "function (hit) { for (var node = hit; node; node = node.parentNode || node.host) {"
+                                   " if (node === this) { return true; } } return false; }",
+            "arguments": [{"objectId": hit}],
+            "returnByValue": True
+        })["result"].get("value")
+        if not inside:
+            raise ValueError(f"{xpath} is covered by another element at ({x:.0f}, {y:.0f})")
+    
+    def type_text(self, xpath: str, text: str, submit: bool = False):
+        """Focus and clear the element, insert text in one event, optionally press Enter"""
+        backend_id = self._resolve(xpath)
+        object_id = self.command("DOM.resolveNode", {"backendNodeId": backend_id})["object"]["objectId"]
+        self.command("Runtime.callFunctionOn", {
+            "objectId": object_id,
+            "functionDeclaration": "function () { this.focus(); if ('value' in this) { this.value = ''; } }"
+        })
+        self.command("Input.insertText", {"text": text})
+        if submit:
+            self.command("Input.dispatchKeyEvent", {"type": "keyDown", "key": "Enter", "code": "Enter",
+                                                    "windowsVirtualKeyCode": 13, "text": "\r"})
+            self.command("Input.dispatchKeyEvent", {"type": "keyUp", "key": "Enter", "code": "Enter",
+                                                    "windowsVirtualKeyCode": 13})
+
+# Spans open in the current context, outermost first. asyncio tasks each get a copy of the context and
+# _in_driver runs driver work in the caller's context, so concurrent phases never see each other's spans.
+_OPEN_SPANS: contextvars.ContextVar = contextvars.ContextVar("open_spans", default=())
+
+class _Span:
+    __slots__ = ("tracer", "name", "attrs", "start", "calls", "token")
+    
+    def __init__(self, tracer: "Tracer", name: str, attrs: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+    
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+    
+    def __enter__(self):
+        self.calls = 0
+        self.token = _OPEN_SPANS.set(_OPEN_SPANS.get() + (self,))
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _OPEN_SPANS.reset(self.token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.attrs["webdriver_calls"] = self.calls
+        self.tracer._record(self.name, self.start, end, self.attrs)
+        return False
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer:
+    """Timed spans and counters for every phase of the agent loop.
+    A disabled tracer hands out a shared no-op span, so instrumentation can stay on in production.
+    Spans are dropped once a task's spans have been exported; without export paths at most max_spans are kept."""
+    # Agents in one process (run_tasks.py, the daemon) append to the same export files
+    _file_lock = threading.Lock()
+    
+    def __init__(self, enabled: bool = False, jsonl_path: Optional[str] = None, chrome_trace_path: Optional[str] = None,
+                 max_spans: int = 100_000):
+        self.enabled = enabled
+        self.jsonl_path = jsonl_path
+        self.chrome_trace_path = chrome_trace_path
+        self.max_spans = max_spans
+        self.spans: List[Dict] = []
+        self.counters: Dict[str, int] = {}
+        self.task_id: Optional[str] = None
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        """AGENT_TRACE=1 enables tracing; AGENT_TRACE_JSONL and AGENT_TRACE_CHROME set export paths"""
+        return cls(
+            enabled=os.getenv("AGENT_TRACE", "").lower() in ("1", "true", "yes"),
+            jsonl_path=os.getenv("AGENT_TRACE_JSONL"),
+            chrome_trace_path=os.getenv("AGENT_TRACE_CHROME")
+        )
+    
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, attrs)
+    
+    def annotate(self, **attrs):
+        """Attach attributes to the innermost open span in the current context"""
+        if self.enabled:
+            stack = self._stack()
+            if stack:
+                stack[-1].set(**attrs)
+    
+    def count(self, name: str, amount: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def instrument_driver(self, driver):
+        """Count WebDriver round trips by wrapping the driver's command dispatch"""
+        if not self.enabled:
+            return
+        original = getattr(driver, "_agent_original_execute", None) or driver.execute
+        driver._agent_original_execute = original
+        
+        def execute(*args, **kwargs):
+            # Charged to the spans open in the calling context only, not to phases running alongside
+            with self._lock:
+                self.counters["webdriver_calls"] = self.counters.get("webdriver_calls", 0) + 1
+                for span in self._stack():
+                    span.calls += 1
+            return original(*args, **kwargs)
+        driver.execute = execute
+    
+    def _stack(self) -> List[_Span]:
+        return [span for span in _OPEN_SPANS.get() if span.tracer is self]
+    
+    def _record(self, name: str, start: float, end: float, attrs: Dict):
+        self.spans.append({
+            "name": name,
+            "task": self.task_id,
+            "start_ms": round((start - self._origin) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+            "thread": threading.current_thread().name,
+            "attrs": attrs
+        })
+    
+    def begin_task(self, task_id: str):
+        self.task_id = task_id
+    
+    def summary(self, task_id: Optional[str] = None) -> str:
+        """Per-phase table of count, total/mean/max wall time and WebDriver round trips"""
+        rows: Dict[str, List] = {}
+        for span in self.spans:
+            if task_id is not None and span["task"] != task_id:
+                continue
+            row = rows.setdefault(span["name"], [0, 0.0, 0.0, 0])
+            row[0] += 1
+            row[1] += span["duration_ms"]
+            row[2] = max(row[2], span["duration_ms"])
+            row[3] += span["attrs"].get("webdriver_calls", 0)
+        
+        lines = [f"{'phase':<22}{'count':>7}{'total ms':>12}{'mean ms':>10}{'max ms':>10}{'wd calls':>10}"]
+        for name, (count, total, longest, calls) in sorted(rows.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<22}{count:>7}{total:>12.1f}{total / count:>10.1f}{longest:>10.1f}{calls:>10}")
+        if self.counters:
+            lines.append("counters: " + ", ".join(f"{name}={value}" for name, value in sorted(self.counters.items())))
+        return "\n".join(lines)
+    
+    def export_jsonl(self, path: str):
+        """Append the recorded spans as JSON lines"""
+        with Tracer._file_lock, open(path, 'a') as f:
+            for span in self.spans:
+                f.write(json.dumps(span) + "\n")
+    
+    def export_chrome_trace(self, path: str):
+        """Append the recorded spans in Chrome's JSON array trace format (chrome://tracing, Perfetto). Its closing
+        bracket is optional, so every task and agent can add to the same file instead of overwriting it."""
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            events.append({
+                "name": span["name"],
+                "cat": "agent",
+                "ph": "X",
+                "ts": span["start_ms"] * 1000,
+                "dur": span["duration_ms"] * 1000,
+                "pid": pid,
+                "tid": span["thread"],
+                "args": dict(span["attrs"], task=span["task"])
+            })
+        with Tracer._file_lock, open(path, 'a') as f:
+            if f.tell() == 0:
+                f.write("[\n")
+            for event in events:
+                f.write(json.dumps(event) + ",\n")
+    
+    def finish_task(self):
+        if not self.enabled:
+            return
+        print(f"\nTrace summary for task {self.task_id}:\n{self.summary(self.task_id)}")
+        if self.jsonl_path:
+            self.export_jsonl(self.jsonl_path)
+        if self.chrome_trace_path:
+            self.export_chrome_trace(self.chrome_trace_path)
+        with self._lock:
+            if self.jsonl_path or self.chrome_trace_path:
+                self.spans = []
+            elif len(self.spans) > self.max_spans:
+                self.spans = self.spans[-self.max_spans:]
+
+def traced(name: str):
+    """Wrap an agent method in a tracer span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def launch_chrome(headless: bool = False, images: bool = True, performance_log: bool = False):
+    """images=False replaces images with placeholders. performance_log records DevTools network events
+    so navigations can report blocked requests and transferred bytes."""
+    chrome_options = Options()
+    
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--window-size=1920,1080')
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    
+    chrome_options.add_argument('--disable-web-security')
+    chrome_options.add_argument('--disable-features=VizDisplayCompositor')
+    
+    if headless:
+        chrome_options.add_argument('--headless')
+    if not images:
+        chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+    if performance_log:
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    return driver
+
+def create_model(api_key: str, model_name: str = 'gemini-2.5-flash'):
+    """Gemini client; the first call pays for importing google.generativeai"""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+def startup_timings() -> Dict:
+    """Import cost of this module and of every deferred import used so far, in ms"""
+    return {"module_import_ms": MODULE_IMPORT_MS, "deferred_imports_ms": dict(IMPORT_TIMINGS)}
 
-@dataclass
-class ElementInfo:
-    tag: str
-    text: str
-    xpath: str
-    attributes: Dict[str, str]
-    coordinates: Tuple[int, int, int, int]
-    element_id: str
+def reset_browser_state(driver):
+    """Return a driver to a blank state between tasks: one tab, no cookies, cache or site data.
+    Site data (local storage, IndexedDB, service workers, cache storage) is cleared for every origin in the
+    history of every tab, since storage can only be cleared per origin."""
+    origins = set()
+    handles = driver.window_handles
+    for handle in handles:
+        driver.switch_to.window(handle)
+        try:
+            history = driver.execute_cdp_cmd("Page.getNavigationHistory", {})
+        except Exception:
+            history = {"entries": [{"url": driver.current_url}]}
+        for entry in history.get("entries", []):
+            parsed = urlparse(entry.get("url", ""))
+            if parsed.scheme in ("http", "https") and parsed.netloc:
+                origins.add(f"{parsed.scheme}://{parsed.netloc}")
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(handles[0])
+    
+    try:
+        for origin in origins:
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    except Exception:
+        try:
+            driver.execute_script("try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}")
+        except Exception:
+            pass
+        driver.delete_all_cookies()
+    driver.get("about:blank")
 
 class WebNavigationAgent:
-    def __init__(self, gemini_api_key: str, headless: bool = False):
+    def __init__(self, gemini_api_key: str, headless: bool = False, extraction_mode: str = "script", max_elements: int = 50,
+                 incremental: bool = False, max_history_turns: int = 6, screenshot_config: Optional[ScreenshotConfig] = None,
+                 decision_cache: Optional[DecisionCache] = None, readiness: Optional[ReadinessConfig] = None, driver=None,
+                 trajectory_store: Optional[TrajectoryStore] = None, prompt_format: str = "compact", element_token_budget: int = 3000,
+                 tracer: Optional[Tracer] = None, model=None, rank_elements: bool = True, max_repeats: int = 3,
+                 max_consecutive_failures: int = 3, locate_timeout: float = 2.0, transport: str = "webdriver",
+                 load_profile: Union[str, LoadProfile] = "full", site_profiles: Optional[Dict[str, Union[str, LoadProfile]]] = None,
+                 recorder: Optional[RunRecorder] = None, modality: str = "full", modality_policy: Optional[ModalityPolicy] = None,
+                 rate_limiter: Optional[RateLimiter] = None, response_mode: str = "text", navigation_stats: bool = False):
+        """extraction_mode is "script" (single injected script) or "xpath" (one WebDriver call per element).
+        incremental sends only the elements that changed since the previous step while the page stays the same.
+        driver reuses an already launched WebDriver (e.g. from a BrowserPool); the agent then leaves it open on close().
+        prompt_format is "compact" (numeric handles in a token-budgeted table) or "json" (full XPaths and attributes).
+        model replaces the Gemini client, e.g. with a scripted stub for offline benchmarks.
+        rank_elements keeps the max_elements candidates most relevant to the task instead of the first ones in
+        selector order (script extraction only).
+        max_repeats stops a task once the same action has been proposed that many times on an unchanged page, and
+        max_consecutive_failures once that many steps in a row failed (0 disables either check).
+        locate_timeout bounds how long an action waits for a target that is not in the element registry.
+        transport "cdp" takes screenshots, element lists (non-incremental script extraction), clicks and typing
+        through the Chrome DevTools Protocol, falling back to WebDriver whenever a CDP call fails.
+        load_profile (a LOAD_PROFILES name or a LoadProfile) decides which resources are blocked while pages load;
+        site_profiles overrides it per host, e.g. {"amazon.in": "minimal"}, matching subdomains too.
+        navigation_stats turns on the DevTools performance log so navigations also count cross-origin bytes; the
+        log is on anyway whenever a profile blocks something, to count the blocked requests.
+        recorder receives every step's screenshot with the chosen action drawn on it and is closed with the agent.
+        modality "full" sends a screenshot with every prompt; "adaptive" starts text-only and escalates to a
+        downscaled, then a full screenshot as modality_policy decides.
+        rate_limiter defaults to the process-wide RateLimiter.shared(), so concurrent agents share one quota.
+        response_mode "text" parses a JSON block out of the finished reply; "streamed" constrains the reply to
+        STREAMED_RESPONSE_SCHEMA and starts acting as soon as its action fields have streamed in."""
+        if extraction_mode not in ("script", "xpath"):
+            raise ValueError(f"Unknown extraction mode: {extraction_mode}")
+        if transport not in ("webdriver", "cdp"):
+            raise ValueError(f"Unknown transport: {transport}")
+        if modality not in ("full", "adaptive"):
+            raise ValueError(f"Unknown modality: {modality}")
+        if prompt_format not in ("compact", "json"):
+            raise ValueError(f"Unknown prompt format: {prompt_format}")
+        if response_mode not in ("text", "streamed"):
+            raise ValueError(f"Unknown response mode: {response_mode}")
+        
         self.gemini_api_key = gemini_api_key
         self.headless = headless
-        self.driver = None
-        self.wait = None
+        self.extraction_mode = extraction_mode
+        self.max_elements = max_elements
+        self.incremental = incremental
+        self.max_history_turns = max_history_turns
+        self.screenshot_config = screenshot_config or ScreenshotConfig()
+        self.last_screenshot: Optional[Screenshot] = None
+        self.decision_cache = decision_cache
+        self.last_fingerprint: Optional[str] = None
+        self.readiness = readiness or ReadinessConfig()
+        self.readiness_log: List[Dict] = []
+        self.trajectory_store = trajectory_store
+        self.last_action: Optional[Dict] = None
+        self.prompt_format = prompt_format
+        self.element_token_budget = element_token_budget
+        self.tracer = tracer or Tracer.from_env()
+        self.rank_elements = rank_elements
+        self.current_task: Optional[str] = None
+        self.max_repeats = max_repeats
+        self.max_consecutive_failures = max_consecutive_failures
+        self.last_state: Optional[str] = None
+        self.locate_timeout = locate_timeout
+        self.element_registry = ElementRegistry()
+        self.transport = transport
+        self.cdp: Optional[CdpTransport] = None
+        self.load_profile = resolve_load_profile(load_profile)
+        self.site_profiles = {host: resolve_load_profile(profile) for host, profile in (site_profiles or {}).items()}
+        self.navigation_log: List[Dict] = []
+        self._blocked_urls: Optional[List[str]] = None
+        self._performance_log = navigation_stats or needs_performance_log(self.load_profile, *self.site_profiles.values())
+        self.recorder = recorder
+        self.last_page_info: Optional[Dict] = None
+        self.modality = modality
+        self.modality_policy = modality_policy or ModalityPolicy()
+        self.modality_stats = self._new_modality_stats()
+        self.previous_step_failed = False
+        self.rate_limiter = rate_limiter or RateLimiter.shared()
+        self.task_progress = 0.0
+        self.response_mode = response_mode
+        self.response_stats = self._new_response_stats()
+        self._llm_started: Optional[float] = None
+        # Follow-up (plan and alternatives) of a streamed action dispatched before it had arrived
+        self._pending_followup: Optional[Future] = None
+        self.metrics = {"tasks": 0, "tasks_completed": 0, "steps": 0, "completed_steps": 0, "llm_calls": 0, "completed_llm_calls": 0, "actions_executed": 0, "prompt_tokens": 0}
+        
+        # WebDriver calls block, so they run here instead of on the event loop. Two
+        # workers let the screenshot encode overlap with element extraction.
+        self._driver_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="webdriver")
+        self.driver = driver
+        self._owns_driver = False
+        
+        self._element_cache: Dict[int, ElementInfo] = {}
+        self._handles: Dict[int, ElementInfo] = {}
+        self._history: List[Dict] = []
+        self._force_full_snapshot = False
+        self._notes: List[str] = []
+        self._typed_texts: List[str] = []
         
-        genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # Importing and configuring Gemini overlaps with the Chrome launch instead of preceding it
+        self.startup: Dict[str, float] = {}
+        model_future = None
+        if model is None:
+            model_future = self._driver_executor.submit(self._create_model, gemini_api_key)
         
         self.setup_browser()
+        if model_future is not None:
+            try:
+                model = model_future.result()
+            except Exception:
+                self.close()
+                raise
+        self.model = model
+        self.token_counter = TokenCounter(model)
+    
+    @classmethod
+    async def create(cls, *args, **kwargs) -> "WebNavigationAgent":
+        """Construct an agent without blocking the event loop while Chrome starts"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(cls, *args, **kwargs))
+    
+    async def _in_driver(self, fn, *args, **kwargs):
+        """Run a blocking WebDriver call on the agent's driver executor, in the caller's context"""
+        loop = asyncio.get_running_loop()
+        # The caller's context carries its open spans, so the call is traced as part of them
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._driver_executor, functools.partial(context.run, fn, *args, **kwargs))
+    
+    def _create_model(self, api_key: str):
+        start = time.perf_counter()
+        model = create_model(api_key)
+        self.startup["model_init_s"] = round(time.perf_counter() - start, 3)
+        return model
     
     def setup_browser(self):
-        chrome_options = Options()
+        if self.driver is None:
+            start = time.perf_counter()
+            self.driver = launch_chrome(self.headless, images=not self.load_profile.image_placeholders,
+                                        performance_log=self._performance_log)
+            self.startup["browser_launch_s"] = round(time.perf_counter() - start, 3)
+            self._owns_driver = True
         
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--disable-gpu')
-        chrome_options.add_argument('--window-size=1920,1080')
-        chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-        chrome_options.add_experimental_option('useAutomationExtension', False)
+        self.tracer.instrument_driver(self.driver)
         
-        chrome_options.add_argument('--disable-web-security')
-        chrome_options.add_argument('--disable-features=VizDisplayCompositor')
+        max_wait = max(list(self.readiness.timeouts.values()) + [self.readiness.default_timeout])
+        self.driver.set_script_timeout(max_wait + 5)
+        if not getattr(self.driver, "_agent_hooks_installed", False):
+            try:
+                self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": NETWORK_HOOKS_JS})
+                self.driver._agent_hooks_installed = True
+            except Exception as e:
+                print(f"Network hooks will be installed on demand: {e}")
         
-        if self.headless:
-            chrome_options.add_argument('--headless')
+        try:
+            self.driver.execute_cdp_cmd("Network.enable", {})
+            self._apply_load_profile(self.load_profile)
+        except Exception as e:
+            print(f"Load profiles unavailable, loading every resource: {e}")
         
-        self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        self.wait = WebDriverWait(self.driver, 10)
+        if self.transport == "cdp":
+            if hasattr(self.driver, "execute_cdp_cmd"):
+                self.cdp = CdpTransport(self.driver)
+            else:
+                print("This driver has no DevTools access, using WebDriver transport")
         
         print("Browser initialized successfully")
     
-    def take_screenshot(self) -> str:
-        screenshot = self.driver.get_screenshot_as_png()
-        return base64.b64encode(screenshot).decode('utf-8')
+    @traced("screenshot")
+    def capture_screenshot(self, config: Optional[ScreenshotConfig] = None) -> Screenshot:
+        """Capture the viewport (or the configured element region) and encode it for the model"""
+        config = config or self.screenshot_config
+        
+        start = time.perf_counter()
+        encoded = None
+        if self.cdp is not None:
+            # Chrome clips, scales and encodes, so there is nothing left to do in PIL
+            try:
+                encoded = self.cdp.capture_screenshot(config, self._region_rect(config.region) if config.region else None)
+            except Exception as e:
+                self._cdp_fallback("screenshot", e)
+        if encoded is None:
+            if config.region:
+                png = self.driver.find_element(By.XPATH, config.region).screenshot_as_png
+            else:
+                png = self.driver.get_screenshot_as_png()
+        capture_ms = (time.perf_counter() - start) * 1000
+        
+        start = time.perf_counter()
+        if encoded is None:
+            encoded = encode_screenshot(png, config)
+        data, mime_type, width, height = encoded
+        encode_ms = (time.perf_counter() - start) * 1000
+        
+        screenshot = Screenshot(data=data, mime_type=mime_type, width=width, height=height, capture_ms=capture_ms, encode_ms=encode_ms)
+        self.last_screenshot = screenshot
+        self.tracer.annotate(capture_ms=round(capture_ms, 2), encode_ms=round(encode_ms, 2), bytes=screenshot.size)
+        print(f"Screenshot: {width}x{height} {config.format}, {screenshot.size / 1024:.1f} KB "
+              f"(capture {capture_ms:.0f} ms, encode {encode_ms:.0f} ms)")
+        return screenshot
+    
+    def _region_rect(self, xpath: str) -> Tuple[float, float, float, float]:
+        """Page coordinates of the element at xpath"""
+        return tuple(self.driver.execute_script("""
+            var element = document.evaluate(arguments[0], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+            var rect = element.getBoundingClientRect();
+            return [rect.left + window.scrollX, rect.top + window.scrollY, rect.width, rect.height];
+        """, xpath))
+    
+    def _cdp_fallback(self, operation: str, error: Exception):
+        print(f"CDP {operation} failed, falling back to WebDriver: {error}")
+        self.tracer.count("cdp_fallbacks")
+    
+    def _rank_task(self) -> Optional[str]:
+        """Task text the in-page extractor ranks candidates against, or None for document order"""
+        if not self.rank_elements:
+            return None
+        return self.current_task or ""
     
+    @traced("extract_elements")
     def get_page_elements(self) -> List[ElementInfo]:
-        elements = []
+        if self.extraction_mode == "xpath":
+            return self._get_page_elements_xpath()
+        if self.cdp is not None:
+            try:
+                elements = self.cdp.snapshot_elements(self.max_elements, self._rank_task())
+                self.element_registry.clear()
+                for handle, elem in enumerate(elements, 1):
+                    elem.handle = handle
+                return elements
+            except Exception as e:
+                self._cdp_fallback("DOM snapshot", e)
+        return self._get_page_elements_script()
+    
+    def _get_page_elements_script(self) -> List[ElementInfo]:
+        try:
+            result = self.driver.execute_script(
+                EXTRACT_ELEMENTS_SCRIPT, ELEMENT_SELECTORS, ELEMENT_ATTRIBUTES, self.max_elements, self._rank_task(), ELEMENT_CSS_SELECTOR
+            )
+        except Exception as e:
+            print(f"Script extraction failed, falling back to XPath extraction: {e}")
+            return self._get_page_elements_xpath()
         
-        selectors = [
-            "//button", "//input", "//select", "//textarea", 
-            "//a[@href]", "//div[@onclick]", "//span[@onclick]",
-            "//div[@role='button']", "//div[@role='link']",
-            "//div[@role='tab']", "//div[@role='menuitem']",
-            "//h1/a", "//h2/a", "//h3/a", "//h4/a", "//h5/a", "//h6/a",
-            "//li/a", "//p/a", "//span/a",
-            "//div[@tabindex]", "//span[@tabindex]",
-            "//form", "//label[@for]"
-        ]
+        elements = [ElementInfo.from_compact(row) for row in result['rows']]
+        self.element_registry.clear()
+        for handle, (elem, web_element) in enumerate(zip(elements, result['elements']), 1):
+            elem.handle = handle
+            self.element_registry.register(handle, web_element)
+        return elements
+    
+    @traced("extract_elements_delta")
+    def get_page_elements_delta(self, force_full: bool = False) -> ElementDelta:
+        """Return the elements added, changed or removed since the previous call and update the local element cache"""
+        try:
+            result = self.driver.execute_script(
+                SNAPSHOT_ELEMENTS_SCRIPT, ELEMENT_SELECTORS, ELEMENT_ATTRIBUTES, self.max_elements, force_full,
+                self._rank_task(), ELEMENT_CSS_SELECTOR
+            )
+        except Exception as e:
+            print(f"Snapshot failed, falling back to a full rescan: {e}")
+            elements = self.get_page_elements()
+            self._element_cache = {elem.handle: elem for elem in elements}
+            return ElementDelta(full=True, version=0, added=elements, changed=[], removed=[])
+        
+        added = [ElementInfo.from_compact(row) for row in result['added']]
+        changed = [ElementInfo.from_compact(row) for row in result['changed']]
+        
+        if result['full']:
+            self._element_cache = {}
+            self.element_registry.clear()
+            removed = []
+        else:
+            removed = [self._element_cache.pop(handle) for handle in result['removed'] if handle in self._element_cache]
+        
+        for elem in removed:
+            self.element_registry.discard(elem.handle)
+        for elem, web_element in zip(added + changed, result['added_elements'] + result['changed_elements']):
+            self._element_cache[elem.handle] = elem
+            self.element_registry.register(elem.handle, web_element)
+        
+        return ElementDelta(full=result['full'], version=result['version'], added=added, changed=changed, removed=removed)
+    
+    def _get_page_elements_xpath(self) -> List[ElementInfo]:
+        elements = []
+        self.element_registry.clear()
         
-        for selector in selectors:
+        for selector in ELEMENT_SELECTORS:
             try:
                 web_elements = self.driver.find_elements(By.XPATH, selector)
                 for i, element in enumerate(web_elements):
@@ -101,39 +2280,22 @@ class WebNavigationAgent:
                             xpath=self._get_xpath(element),
                             attributes=self._get_element_attributes(element),
                             coordinates=(rect['x'], rect['y'], rect['width'], rect['height']),
-                            element_id=f"{element.tag_name}_{i}"
+                            element_id=f"{element.tag_name}_{i}",
+                            handle=len(elements) + 1
                         )
                         elements.append(element_info)
+                        self.element_registry.register(element_info.handle, element)
                     except Exception as e:
                         continue
             except Exception as e:
                 continue
         
-        return elements[:50] 
+        return elements[:self.max_elements] 
     
+    @traced("xpath_script")
     def _get_xpath(self, element) -> str:
         try:
-            return self.driver.execute_script("""
-                function getXPath(element) {
-                    if (element.id !== '') {
-                        return `//*[@id="${element.id}"]`;
-                    }
-                    if (element === document.body) {
-                        return '/html/body';
-                    }
-                    
-                    var ix = 0;
-                    var siblings = element.parentNode.childNodes;
-                    for (var i = 0; i < siblings.length; i++) {
-                        var sibling = siblings[i];
-                        if (sibling === element) {
-                            return getXPath(element.parentNode) + '/' + element.tagName.toLowerCase() + '[' + (ix + 1) + ']';
-                        }
-                        if (sibling.nodeType === 1 && sibling.tagName === element.tagName) {
-                            ix++;
-                        }
-                    }
-                }
+            return self.driver.execute_script(XPATH_FUNCTION_JS + """
                 return getXPath(arguments[0]);
             """, element)
         except:
@@ -142,8 +2304,7 @@ class WebNavigationAgent:
     def _get_element_attributes(self, element) -> Dict[str, str]:
         attributes = {}
         try:
-            attr_names = ['id', 'class', 'name', 'type', 'href', 'title', 'placeholder', 'value', 'role', 'aria-label', 'data-testid']
-            for attr in attr_names:
+            for attr in ELEMENT_ATTRIBUTES:
                 value = element.get_attribute(attr)
                 if value:
                     attributes[attr] = value[:100]
@@ -151,97 +2312,284 @@ class WebNavigationAgent:
             pass
         return attributes
     
+    @traced("readiness_wait")
+    def wait_for_page_ready(self, action: str, timeout: Optional[float] = None) -> Dict:
+        """Wait until the page settles after an action, bounded by the action's timeout"""
+        if timeout is None:
+            timeout = self.readiness.timeouts.get(action, self.readiness.default_timeout)
+        
+        start = time.perf_counter()
+        deadline = start + timeout
+        result = {"ready": False, "pending": ["document"]}
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                result = self.driver.execute_async_script(WAIT_FOR_READY_SCRIPT, remaining * 1000, self.readiness.quiet_ms)
+                break
+            except selenium_exceptions.WebDriverException as e:
+                message = str(e.msg or e).lower()
+                if isinstance(e, selenium_exceptions.StaleElementReferenceException) or any(
+                    marker in message for marker in NAVIGATION_ERROR_MARKERS
+                ):
+                    # The document was replaced while waiting (navigation); wait on the new one
+                    time.sleep(0.05)
+                    continue
+                print(f"Readiness wait failed after {action}: {e.msg or e}")
+                result = {"ready": False, "pending": ["error"]}
+                break
+        
+        waited_ms = (time.perf_counter() - start) * 1000
+        record = {"action": action, "waited_ms": round(waited_ms, 1), "ready": result.get("ready", False), "pending": result.get("pending", [])}
+        self.readiness_log.append(record)
+        self.tracer.annotate(**record)
+        if not record["ready"]:
+            print(f"Page not settled after {action} ({waited_ms:.0f} ms), pending: {', '.join(record['pending'])}")
+        return record
+    
+    def _profile_for(self, url: str) -> LoadProfile:
+        host = urlparse(url).hostname or ""
+        for site, profile in self.site_profiles.items():
+            if host == site or host.endswith("." + site):
+                return profile
+        return self.load_profile
+    
+    def _apply_load_profile(self, profile: LoadProfile):
+        """Install the profile's blocked URL patterns and script deferral unless they are already active"""
+        urls = profile.blocked_urls()
+        if urls != self._blocked_urls:
+            self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": urls})
+            self._blocked_urls = urls
+        
+        # Kept on the driver, like the network hooks, since pooled drivers outlive their agents
+        script_id = getattr(self.driver, "_agent_defer_script_id", None)
+        if profile.defer_third_party_scripts and script_id is None:
+            self.driver._agent_defer_script_id = self.driver.execute_cdp_cmd(
+                "Page.addScriptToEvaluateOnNewDocument", {"source": DEFER_THIRD_PARTY_SCRIPTS_JS}
+            )["identifier"]
+        elif not profile.defer_third_party_scripts and script_id is not None:
+            self.driver.execute_cdp_cmd("Page.removeScriptToEvaluateOnNewDocument", {"identifier": script_id})
+            self.driver._agent_defer_script_id = None
+    
+    def _read_performance_log(self) -> List[Dict]:
+        """DevTools network events logged since the last call (empty if the driver was launched without the log)"""
+        if not self._performance_log:
+            return []
+        try:
+            entries = self.driver.get_log("performance")
+        except Exception:
+            self._performance_log = False
+            return []
+        events = []
+        for entry in entries:
+            message = json.loads(entry["message"])["message"]
+            if message["method"] in ("Network.loadingFinished", "Network.loadingFailed", "Network.responseReceived"):
+                events.append(message)
+        return events
+    
+    def _navigation_stats(self, url: str, profile: LoadProfile, load_ms: float, ready_ms: float) -> Dict:
+        """load_ms is driver.get alone (network and the load event); ready_ms is the readiness wait after it"""
+        record = {"url": url, "profile": profile.name, "load_ms": round(load_ms, 1), "ready_ms": round(ready_ms, 1),
+                  "blocked_requests": 0, "blocked_by_type": {}}
+        try:
+            record.update(self.driver.execute_script(NAVIGATION_TIMING_SCRIPT))
+        except Exception:
+            pass
+        
+        # The log sees cross-origin bytes that Resource Timing reports as 0, and the requests that never went out
+        events = self._read_performance_log()
+        if events:
+            types = {}
+            transferred = 0
+            for event in events:
+                params = event["params"]
+                if event["method"] == "Network.responseReceived":
+                    types[params["requestId"]] = params.get("type", "Other")
+                elif event["method"] == "Network.loadingFinished":
+                    transferred += params.get("encodedDataLength", 0)
+                elif params.get("blockedReason"):
+                    record["blocked_requests"] += 1
+                    resource_type = params.get("type") or types.get(params["requestId"], "Other")
+                    record["blocked_by_type"][resource_type] = record["blocked_by_type"].get(resource_type, 0) + 1
+            record["transferred_bytes"] = transferred
+        return record
+    
+    @traced("navigate")
     def navigate_to(self, url: str):
         try:
+            self.element_registry.clear()
+            if self.cdp is not None:
+                self.cdp.forget()
+            
+            profile = self._profile_for(url)
+            if self._blocked_urls is not None:
+                self._apply_load_profile(profile)
+            self._read_performance_log()
+            
+            start = time.perf_counter()
             self.driver.get(url)
-            time.sleep(3)
-            print(f"Navigated to: {url}")
+            loaded = time.perf_counter()
+            self.wait_for_page_ready("navigate")
+            stats = self._navigation_stats(url, profile, (loaded - start) * 1000, (time.perf_counter() - loaded) * 1000)
+            self.navigation_log.append(stats)
+            self.tracer.annotate(profile=profile.name, transferred_bytes=stats.get("transferred_bytes"),
+                                 blocked_requests=stats["blocked_requests"])
+            print(f"Navigated to: {url} ({profile.name} profile, {stats['load_ms'] / 1000:.2f} s load + "
+                  f"{stats['ready_ms'] / 1000:.2f} s ready, {(stats.get('transferred_bytes') or 0) / 1024:.0f} KB, "
+                  f"{stats['blocked_requests']} blocked, {stats.get('deferred_scripts', 0)} scripts deferred)")
             return True
         except Exception as e:
             print(f"Error navigating to {url}: {e}")
             return False
     
-    def click_element(self, xpath: str) -> bool:
+    def _registry_handle(self, xpath: str, handle: Optional[int] = None) -> Optional[int]:
+        """The handle whose registered WebElement is the element at xpath: the model's handle while it still
+        names that XPath, otherwise the only current element with that XPath"""
+        elem = self._handles.get(handle) if handle is not None else None
+        if elem is not None and elem.xpath == xpath:
+            return handle
+        matches = [elem.handle for elem in self._handles.values() if elem.xpath == xpath]
+        return matches[0] if len(matches) == 1 else None
+    
+    def _locate(self, xpath: str, handle: Optional[int], fresh: bool = False):
+        """The registered WebElement for handle, or the element at xpath found within locate_timeout.
+        Raises TimeoutException if it does not appear."""
+        if not fresh:
+            element = self.element_registry.get(handle)
+            if element is not None:
+                return element
+        element = WebDriverWait(self.driver, self.locate_timeout).until(EC.presence_of_element_located((By.XPATH, xpath)))
+        self.element_registry.register(handle, element)
+        return element
+    
+    @traced("click")
+    def click_element(self, xpath: str, handle: Optional[int] = None) -> bool:
+        if self.cdp is not None and self.cdp.knows(xpath):
+            try:
+                self.cdp.click(xpath)
+                self.tracer.annotate(click_strategy="cdp")
+                self.wait_for_page_ready("click")
+                print(f"Clicked element via CDP: {xpath}")
+                return True
+            except Exception as e:
+                self._cdp_fallback("click", e)
+        
+        # A stored reference is tried first; if it went stale the element is located once more
+        handle = self._registry_handle(xpath, handle)
+        for fresh in (False, True):
+            try:
+                element = self._locate(xpath, handle, fresh)
+                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", element)
+                return self._click(element, xpath)
+            except selenium_exceptions.StaleElementReferenceException:
+                self.element_registry.discard(handle, stale=True)
+                self.tracer.count("stale_elements")
+            except selenium_exceptions.TimeoutException:
+                print(f"Element not found within {self.locate_timeout} s: {xpath}")
+                return False
+            except Exception as e:
+                print(f"Error clicking element {xpath}: {e}")
+                return False
+        return False
+    
+    def _click(self, element, xpath: str) -> bool:
+        """Native click, falling back to a JavaScript click and then ActionChains. Stale references propagate."""
         try:
-            element = self.wait.until(EC.element_to_be_clickable((By.XPATH, xpath)))
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", element)
-            time.sleep(1)
             element.click()
-            time.sleep(1)
+            self.tracer.annotate(click_strategy="native")
+            self.wait_for_page_ready("click")
             print(f"Clicked element: {xpath}")
             return True
-            
-        except ElementClickInterceptedException:
-            print("Click intercepted, trying JavaScript click...")
-            try:
-                element = self.driver.find_element(By.XPATH, xpath)
-                self.driver.execute_script("arguments[0].click();", element)
-                time.sleep(1)
-                print(f"JavaScript clicked element: {xpath}")
-                return True
-            except Exception as e2:
-                print(f"JavaScript click failed: {e2}")
-                
-        except TimeoutException:
-            print("Element not clickable, trying to find and click anyway...")
+        except selenium_exceptions.StaleElementReferenceException:
+            raise
+        except selenium_exceptions.WebDriverException as e:
+            print(f"Native click failed ({type(e).__name__}), trying JavaScript click...")
+        
+        try:
+            self.driver.execute_script("arguments[0].click();", element)
+            self.tracer.annotate(click_strategy="javascript")
+            self.wait_for_page_ready("click")
+            print(f"JavaScript clicked element: {xpath}")
+            return True
+        except selenium_exceptions.StaleElementReferenceException:
+            raise
+        except selenium_exceptions.WebDriverException as e:
+            print(f"JavaScript click failed: {e}")
+        
+        try:
+            ActionChains(self.driver).move_to_element(element).click().perform()
+            self.tracer.annotate(click_strategy="action_chains")
+            self.wait_for_page_ready("click")
+            print(f"ActionChains clicked element: {xpath}")
+            return True
+        except selenium_exceptions.StaleElementReferenceException:
+            raise
+        except selenium_exceptions.WebDriverException as e:
+            print(f"ActionChains click failed: {e}")
+        return False
+    
+    @traced("type")
+    def type_text(self, xpath: str, text: str, submit: bool = False, handle: Optional[int] = None) -> bool:
+        if self.cdp is not None and self.cdp.knows(xpath):
             try:
-                element = self.driver.find_element(By.XPATH, xpath)
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", element)
-                time.sleep(1)
-                self.driver.execute_script("arguments[0].click();", element)
-                time.sleep(1)
-                print(f"Force clicked element: {xpath}")
+                self.cdp.type_text(xpath, text, submit)
+                self.wait_for_page_ready("navigate" if submit else "type")
+                print(f"Typed '{text}' into element via CDP: {xpath}{' and submitted' if submit else ''}")
                 return True
-            except Exception as e3:
-                print(f"Force click failed: {e3}")
-                
-        except Exception as e:
-            print(f"Error clicking element {xpath}: {e}")
-            
+            except Exception as e:
+                self._cdp_fallback("typing", e)
+        
+        handle = self._registry_handle(xpath, handle)
+        for fresh in (False, True):
             try:
-                element = self.driver.find_element(By.XPATH, xpath)
-                actions = ActionChains(self.driver)
-                actions.move_to_element(element).click().perform()
-                time.sleep(1)
-                print(f"ActionChains clicked element: {xpath}")
+                element = self._locate(xpath, handle, fresh)
+                element.clear()
+                if submit:
+                    element.send_keys(text, Keys.ENTER)
+                    self.wait_for_page_ready("navigate")
+                else:
+                    element.send_keys(text)
+                    self.wait_for_page_ready("type")
+                print(f"Typed '{text}' into element: {xpath}{' and submitted' if submit else ''}")
                 return True
-            except Exception as e4:
-                print(f"ActionChains click failed: {e4}")
-        
+            except selenium_exceptions.StaleElementReferenceException:
+                self.element_registry.discard(handle, stale=True)
+                self.tracer.count("stale_elements")
+            except Exception as e:
+                print(f"Error typing into element {xpath}: {e}")
+                return False
         return False
     
-    def type_text(self, xpath: str, text: str) -> bool:
-        try:
-            element = self.wait.until(EC.presence_of_element_located((By.XPATH, xpath)))
-            element.clear()
-            element.send_keys(text)
-            time.sleep(0.5)
-            print(f"Typed '{text}' into element: {xpath}")
-            return True
-        except Exception as e:
-            print(f"Error typing into element {xpath}: {e}")
-            return False
-    
+    @traced("scroll")
     def scroll_page(self, direction: str = "down", pixels: int = 300):
         try:
             if direction == "down":
                 self.driver.execute_script(f"window.scrollBy(0, {pixels});")
             elif direction == "up":
                 self.driver.execute_script(f"window.scrollBy(0, -{pixels});")
-            time.sleep(1)
+            self.wait_for_page_ready("scroll")
             print(f"Scrolled {direction} by {pixels} pixels")
             return True
         except Exception as e:
             print(f"Error scrolling: {e}")
             return False
     
+    @traced("page_info")
     def get_page_info(self) -> Dict:
-        return {
-            "url": self.driver.current_url,
-            "title": self.driver.title,
-            "page_source_length": len(self.driver.page_source),
-            "window_size": self.driver.get_window_size()
-        }
+        info = self.driver.execute_script("""
+            return {
+                url: window.location.href,
+                title: document.title,
+                page_source_length: document.documentElement.outerHTML.length,
+                window_size: {width: window.outerWidth, height: window.outerHeight},
+                viewport_width: window.innerWidth,
+                viewport_height: window.innerHeight,
+                scroll_x: Math.round(window.scrollX),
+                scroll_y: Math.round(window.scrollY)
+            };
+        """)
+        return info
     
     def find_clickable_links(self) -> List[str]:
         xpaths = [
@@ -266,210 +2614,962 @@ class WebNavigationAgent:
                 
         return links[:10]
     
-    async def analyze_page_with_ai(self, task: str) -> Dict:
-        """Analyze current page with Gemini AI"""
+    async def analyze_page_with_ai(self, task: str, on_action=None) -> Dict:
+        """Analyze current page with Gemini AI.
+        In streamed response mode, on_action (a coroutine function) is started with the response as soon as its
+        action fields are complete and is awaited before returning; it is not called for cached decisions."""
+        self.current_task = task
+        adaptive = self.modality == "adaptive"
+        self._llm_started = None
         try:
-            screenshot_b64 = self.take_screenshot()
-            
-            elements = self.get_page_elements()
-            
-            page_info = self.get_page_info()
-            
-            elements_summary = []
-            for elem in elements:
-                elements_summary.append({
-                    "id": elem.element_id,
-                    "tag": elem.tag,
-                    "text": elem.text,
-                    "attributes": elem.attributes,
-                    "xpath": elem.xpath,
-                    "coordinates": elem.coordinates
-                })
-            
-            prompt = f"""
-            You are an AI agent helping to navigate any website. 
-            
-            TASK: {task}
-            
-            CURRENT PAGE INFO:
-            - URL: {page_info['url']}
-            - Title: {page_info['title']}
-            
-            AVAILABLE ELEMENTS:
-            {json.dumps(elements_summary, indent=2)}
-            
-            INSTRUCTIONS:
-            1. Analyze the current page and available elements
-            2. Choose the best element to interact with based on the task
-            3. Consider element visibility, coordinates, and attributes
-            4. For links, prefer elements with meaningful text or titles
-            5. For forms, identify input fields and submit buttons
-            6. If multiple similar elements exist, choose the most prominent one
+            with self.tracer.span("observe"):
+                if adaptive and self.recorder is None:
+                    # The screenshot is only taken if the policy escalates
+                    screenshot = None
+                    page_info, elements, elements_section = await self._in_driver(self._observe_page)
+                else:
+                    screenshot, (page_info, elements, elements_section) = await asyncio.gather(
+                        self._in_driver(self.capture_screenshot),
+                        self._in_driver(self._observe_page)
+                    )
             
-            Based on the screenshot and available elements, provide your analysis in JSON format:
-            {{
-                "analysis": "Your analysis of the current page and how it relates to the task",
-                "next_action": "click|type|scroll|navigate|wait",
-                "target_element": "xpath of target element (if applicable)",
-                "input_text": "text to input (if action is type)",
-                "scroll_direction": "up|down (if action is scroll)",
-                "reasoning": "Why you chose this action and element",
-                "confidence": "1-10 scale of confidence in this action",
-                "alternative_actions": ["list of alternative XPaths or actions if primary fails"],
-                "task_progress": "assessment of how close we are to completing the task"
-            }}
+            self.last_page_info = page_info
             
-            Focus on finding the most relevant elements for the task. Be specific about XPath selections.
-            """
+            # Cheap state key for loop detection; scroll position counts as progress
+            self.last_state = f"{page_fingerprint(page_info['url'], page_info['title'], elements)}@{page_info.get('scroll_y', 0)}"
             
-            image_data = base64.b64decode(screenshot_b64)
-            image = Image.open(BytesIO(image_data))
+            if self.decision_cache is not None:
+                with self.tracer.span("fingerprint"):
+                    loop = asyncio.get_running_loop()
+                    self.last_fingerprint = await loop.run_in_executor(
+                        None, page_fingerprint, page_info['url'], page_info['title'], elements, screenshot
+                    )
             
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    response = self.model.generate_content([prompt, image])
-                    break
-                except Exception as e:
-                    print(f"Gemini API attempt {attempt + 1} failed: {e}")
-                    if attempt == max_retries - 1:
-                        raise e
-                    time.sleep(2)
+            if self.decision_cache is not None:
+                cached_decision = self.decision_cache.get(task, self.last_fingerprint)
+                if cached_decision is not None:
+                    print(f"Decision cache hit for fingerprint {self.last_fingerprint}")
+                    self.tracer.count("decision_cache_hits")
+                    cached_decision["cached"] = True
+                    if self.incremental:
+                        # This step's delta bypassed the model, so the history no longer matches the page registry
+                        self._force_full_snapshot = True
+                    return cached_decision
             
-            try:
-                response_text = response.text
-                if "```json" in response_text:
-                    json_start = response_text.find("```json") + 7
-                    json_end = response_text.find("```", json_start)
-                    json_text = response_text[json_start:json_end].strip()
+            level = self._initial_modality(elements) if adaptive else len(MODALITIES) - 1
+            while True:
+                modality = MODALITIES[level]
+                image = None
+                if modality == "downscaled":
+                    image = await self._in_driver(self.capture_screenshot, self.modality_policy.downscaled)
+                elif modality == "full":
+                    image = screenshot or await self._in_driver(self.capture_screenshot)
+                
+                prompt = self._build_prompt(task, page_info, elements_section, with_image=image is not None)
+                # Only the first prompt of the agent costs a count_tokens request
+                estimated_tokens = await asyncio.get_running_loop().run_in_executor(
+                    None, self.token_counter.count, prompt, "prompt"
+                )
+                print(f"Prompt ({modality}): {len(prompt)} chars, ~{estimated_tokens} tokens "
+                      f"({'model tokenizer ratio' if self.token_counter.calibrated('prompt') else 'estimated'})")
+                
+                parts = [prompt, image.as_part()] if image is not None else [prompt]
+                if self.incremental:
+                    contents = self._history + [{"role": "user", "parts": parts}]
                 else:
-                    json_text = response_text
+                    contents = parts
                 
-                ai_response = json.loads(json_text)
-                return ai_response
+                start = time.perf_counter()
+                if self._llm_started is None:
+                    self._llm_started = start
+                image_bytes = image.size if image is not None else 0
+                image_tokens = estimate_image_tokens(image.width, image.height) if image is not None else 0
+                if self.response_mode == "streamed":
+                    may_escalate = adaptive and level < len(MODALITIES) - 1
+                    response_text, ai_response = await self._stream_response(
+                        contents, prompt, estimated_tokens, image_bytes, image_tokens, on_action, may_escalate
+                    )
+                else:
+                    response = await self._generate(contents, prompt, estimated_tokens, image_bytes, image_tokens)
+                    response_text, ai_response = response.text, None
+                self._record_modality(modality, (time.perf_counter() - start) * 1000, image, page_info)
+                self.response_stats["responses"] += 1
                 
-            except json.JSONDecodeError as e:
-                print(f"Error parsing AI response: {e}")
-                print(f"Raw response: {response.text}")
-                return {
-                    "analysis": "Error parsing AI response",
-                    "next_action": "scroll",
-                    "reasoning": "Failed to parse AI response, defaulting to scroll",
-                    "confidence": 1,
-                    "alternative_actions": ["wait"]
-                }
+                try:
+                    with self.tracer.span("parse_response"):
+                        if ai_response is None:
+                            ai_response = self._resolve_handles(self._flatten_response(self._parse_response(response_text)))
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing AI response: {e}")
+                    print(f"Raw response: {response_text}")
+                    self.tracer.count("parse_failures")
+                    self.response_stats["parse_failures"] += 1
+                    if adaptive and level < len(MODALITIES) - 1:
+                        level = self._escalate(level, "unparseable response")
+                        continue
+                    self._notes = []
+                    # The model never saw this step's element delta; the next step must not diff against it
+                    self._force_full_snapshot = True
+                    return {
+                        "analysis": "Error parsing AI response",
+                        "next_action": "scroll",
+                        "reasoning": "Failed to parse AI response, defaulting to scroll",
+                        "confidence": 1,
+                        "alternative_actions": ["wait"],
+                        "fallback": True
+                    }
+                
+                if adaptive and level < len(MODALITIES) - 1 and self._confidence(ai_response) < self.modality_policy.min_confidence:
+                    level = self._escalate(level, f"confidence {ai_response.get('confidence')}")
+                    continue
+                break
+            
+            self.tracer.annotate(modality=modality)
+            self._notes = []
+            if self.incremental:
+                self._history.append({"role": "user", "parts": [prompt]})
+                self._history.append({"role": "model", "parts": [response_text]})
+                if len(self._history) >= 2 * self.max_history_turns:
+                    self._force_full_snapshot = True
+            
+            return ai_response
                 
         except Exception as e:
             print(f"Error in AI analysis: {e}")
+            self._force_full_snapshot = True
             return {
                 "analysis": "Error in AI analysis",
                 "next_action": "scroll",
                 "reasoning": f"AI analysis failed: {str(e)}",
                 "confidence": 1,
-                "alternative_actions": ["wait"]
+                "alternative_actions": ["wait"],
+                "fallback": True
             }
     
+    def _initial_modality(self, elements: List[ElementInfo]) -> int:
+        if self.previous_step_failed:
+            print("Previous step failed, starting with a downscaled screenshot")
+            return 1
+        if len(elements) < self.modality_policy.min_elements:
+            print(f"Only {len(elements)} elements extracted, starting with a downscaled screenshot")
+            return 1
+        return 0
+    
+    def _escalate(self, level: int, reason: str) -> int:
+        print(f"Escalating from {MODALITIES[level]} to {MODALITIES[level + 1]}: {reason}")
+        self.modality_stats["escalations"] += 1
+        self.tracer.count("modality_escalations")
+        return level + 1
+    
+    @staticmethod
+    def _confidence(ai_response: Dict) -> float:
+        try:
+            return float(str(ai_response.get("confidence", 0)).split("/")[0])
+        except ValueError:
+            return 0.0
+    
+    @staticmethod
+    def _new_modality_stats() -> Dict:
+        return {
+            "calls": {modality: 0 for modality in MODALITIES},
+            "llm_ms": {modality: 0.0 for modality in MODALITIES},
+            "escalations": 0,
+            "image_tokens_saved": 0
+        }
+    
+    def _record_modality(self, modality: str, llm_ms: float, image: Optional[Screenshot], page_info: Dict):
+        """Count the call and the image tokens it saved against sending a full screenshot"""
+        stats = self.modality_stats
+        stats["calls"][modality] += 1
+        stats["llm_ms"][modality] += llm_ms
+        if modality != "full":
+            config = self.screenshot_config
+            full_width = min(config.max_width, page_info.get("viewport_width") or config.max_width)
+            full_height = min(config.max_height, page_info.get("viewport_height") or config.max_height)
+            used = estimate_image_tokens(image.width, image.height) if image is not None else 0
+            stats["image_tokens_saved"] += estimate_image_tokens(full_width, full_height) - used
+    
+    def modality_summary(self) -> Dict:
+        """Calls and mean LLM latency per modality for the current task, plus escalations and tokens saved"""
+        stats = self.modality_stats
+        return {
+            "calls": dict(stats["calls"]),
+            "mean_llm_ms": {
+                modality: round(stats["llm_ms"][modality] / stats["calls"][modality], 1)
+                for modality in MODALITIES if stats["calls"][modality]
+            },
+            "escalations": stats["escalations"],
+            "image_tokens_saved": stats["image_tokens_saved"]
+        }
+    
+    @staticmethod
+    def _new_response_stats() -> Dict:
+        return {"responses": 0, "parse_failures": 0, "first_actions": 0, "first_action_ms": 0.0}
+    
+    def response_summary(self) -> Dict:
+        """Parse-failure rate and mean time from the first LLM request of a step to its first action, current task"""
+        stats = self.response_stats
+        return {
+            "mode": self.response_mode,
+            "responses": stats["responses"],
+            "parse_failure_rate": round(stats["parse_failures"] / stats["responses"], 3) if stats["responses"] else 0.0,
+            "mean_first_action_ms": round(stats["first_action_ms"] / stats["first_actions"], 1) if stats["first_actions"] else None
+        }
+    
+    def _build_prompt(self, task: str, page_info: Dict, elements_section: str, with_image: bool = True) -> str:
+        notes_section = ""
+        if self._notes:
+            notes_section = "NOTES FROM PREVIOUS STEPS:\n" + "\n".join(f"- {note}" for note in self._notes)
+        source = "the screenshot and available elements" if with_image else "the available elements (no screenshot this time)"
+        
+        if self.prompt_format == "compact":
+            target_ref = "id"
+            target_hint = "id of target element from AVAILABLE ELEMENTS"
+        else:
+            target_ref = "XPath"
+            target_hint = "xpath of target element"
+        
+        if self.response_mode == "streamed":
+            response_format = f"""Based on {source}, answer in the declared JSON schema, in this order:
+        - "action": next_action (click|type|scroll|navigate|wait|done), target_element ({target_hint}), input_text and submit (if action is type), scroll_direction (if action is scroll), target_url (if action is navigate), evidence (short text copied exactly from the page that proves the task is complete, if action is done) and confidence (1-10)
+        - "followup": plan (follow-up actions, each with action, target_element, input_text, submit, scroll_direction and precondition {{url_contains, element_present}}) and alternative_actions (alternative {target_ref}s or actions if the primary fails)
+        - "notes": task_progress, reasoning and analysis, kept short"""
+        else:
+            response_format = f"""Based on {source}, provide your analysis in JSON format:
+        {{
+            "analysis": "Your analysis of the current page and how it relates to the task",
+            "next_action": "click|type|scroll|navigate|wait|done",
+            "target_element": "{target_hint} (if applicable)",
+            "evidence": "short text copied exactly from the page that proves the task is complete (if action is done)",
+            "input_text": "text to input (if action is type)",
+            "submit": "true to press Enter after typing (if action is type)",
+            "scroll_direction": "up|down (if action is scroll)",
+            "plan": [
+                {{
+                    "action": "click|type|scroll|navigate|wait",
+                    "target_element": "{target_ref} (if applicable)",
+                    "input_text": "text (if action is type)",
+                    "submit": "true|false (if action is type)",
+                    "scroll_direction": "up|down (if action is scroll)",
+                    "precondition": {{"url_contains": "text the URL must contain before this step, if it should have changed", "element_present": "{target_ref} of an element that must be present before this step"}}
+                }}
+            ],
+            "reasoning": "Why you chose this action and element",
+            "confidence": "1-10 scale of confidence in this action",
+            "alternative_actions": ["list of alternative {target_ref}s or actions if primary fails"],
+            "task_progress": "assessment of how close we are to completing the task"
+        }}"""
+        
+        prompt = f"""
+        You are an AI agent helping to navigate any website. 
+        
+        TASK: {task}
+        
+        CURRENT PAGE INFO:
+        - URL: {page_info['url']}
+        - Title: {page_info['title']}
+        
+        {elements_section}
+        
+        {notes_section}
+        
+        INSTRUCTIONS:
+        1. Analyze the current page and available elements
+        2. Choose the best element to interact with based on the task
+        3. Consider element visibility, coordinates, and attributes
+        4. For links, prefer elements with meaningful text or titles
+        5. For forms, identify input fields and submit buttons
+        6. If multiple similar elements exist, choose the most prominent one
+        7. When the task is already complete on this page, answer with next_action "done" instead of acting further
+        
+        {response_format}
+        
+        "plan" lists follow-up actions to run after next_action without looking at the page again, in order.
+        Only include steps you are confident about from this page (for example pressing a button right after
+        typing); leave it empty when the outcome of next_action must be seen first.
+        
+        Focus on finding the most relevant elements for the task. Be specific about {target_ref} selections.
+        """
+        
+        if self.prompt_format == "compact":
+            prompt = "\n".join(line.strip() for line in prompt.strip().splitlines())
+        return prompt
+    
+    async def _generate(self, contents: List, prompt: str, estimated_tokens: int, image_bytes: int, image_tokens: int = 0,
+                        **kwargs):
+        """Call Gemini through the shared rate limiter, retrying with backoff, recording token usage.
+        Tasks closer to max_steps get a slot first. kwargs go to generate_content_async; with stream=True
+        only the first chunk is awaited and the caller records usage once the stream is consumed."""
+        limiter = self.rate_limiter
+        reserved = estimated_tokens + image_tokens
+        with self.tracer.span("llm_call", prompt_bytes=len(prompt.encode('utf-8')), image_bytes=image_bytes) as span:
+            queue_wait = 0.0
+            backoff = 0.0
+            for attempt in range(limiter.max_retries):
+                queue_wait += await limiter.acquire(reserved, priority=-self.task_progress)
+                try:
+                    response = await self.model.generate_content_async(contents, **kwargs)
+                except Exception as e:
+                    print(f"Gemini API attempt {attempt + 1} failed: {e}")
+                    self.tracer.count("llm_retries")
+                    limiter.record_failure()
+                    if attempt == limiter.max_retries - 1:
+                        raise e
+                    delay = limiter.backoff(attempt, e)
+                    backoff += delay
+                    print(f"Retrying in {delay:.1f} s")
+                    await asyncio.sleep(delay)
+                    continue
+                
+                self.metrics["llm_calls"] += 1
+                span.set(attempts=attempt + 1, queue_wait_ms=round(queue_wait * 1000, 1), backoff_ms=round(backoff * 1000, 1))
+                if not kwargs.get("stream"):
+                    prompt_tokens, response_tokens = self._record_usage(response, reserved, estimated_tokens)
+                    span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens,
+                             response_bytes=len(response.text.encode('utf-8')))
+                return response
+    
+    def _record_usage(self, response, reserved: int, estimated_tokens: int, response_text: str = "") -> Tuple[int, int]:
+        """Settle the rate limiter reservation with the tokens actually used; returns (prompt, response) tokens"""
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or estimated_tokens
+        response_tokens = getattr(usage, "candidates_token_count", 0) or estimate_tokens(response_text)
+        self.rate_limiter.settle(reserved, prompt_tokens + response_tokens)
+        self.metrics["prompt_tokens"] += prompt_tokens
+        print(f"Prompt tokens: {prompt_tokens}")
+        return prompt_tokens, response_tokens
+    
+    async def _stream_response(self, contents: List, prompt: str, estimated_tokens: int, image_bytes: int, image_tokens: int,
+                               on_action=None, may_escalate: bool = False) -> Tuple[str, Optional[Dict]]:
+        """Stream a schema-constrained response and start on_action as soon as its action fields are complete,
+        while the follow-up and the notes keep streaming. The follow-up is handed to execute_plan through
+        _pending_followup when it completes. Stops reading early when the confidence is low enough for the
+        adaptive policy to escalate. Returns the raw text and the flattened response, or None if the stream
+        never produced an action."""
+        generation_config = {"response_mime_type": "application/json", "response_schema": STREAMED_RESPONSE_SCHEMA}
+        response = await self._generate(contents, prompt, estimated_tokens, image_bytes, image_tokens,
+                                        generation_config=generation_config, stream=True)
+        parser = StreamingJsonParser()
+        fields: Dict[Tuple[str, ...], object] = {}
+        ai_response = None
+        dispatched = None
+        followup: Optional[Future] = None
+        labels = {("notes", "task_progress"): "Task Progress", ("notes", "reasoning"): "Reasoning",
+                  ("notes", "analysis"): "AI Analysis"}
+        start = time.perf_counter()
+        with self.tracer.span("stream_response") as span:
+            try:
+                async for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunks without text parts, e.g. the one carrying only the finish reason
+                        continue
+                    for path, value in parser.feed(text):
+                        fields[path] = value
+                        if path in labels:
+                            print(f"{labels[path]}: {value}")
+                        elif path == ("followup",) and followup is not None:
+                            followup.set_result(self._resolve_handles(self._flatten_response({"action": {}, "followup": value})))
+                            span.set(followup_ms=round((time.perf_counter() - start) * 1000, 1))
+                    if ai_response is not None or ("action",) not in fields:
+                        continue
+                    ai_response = self._resolve_handles(self._flatten_response({
+                        "action": fields[("action",)], "followup": fields.get(("followup",))
+                    }))
+                    span.set(action_ms=round((time.perf_counter() - start) * 1000, 1))
+                    if may_escalate and self._confidence(ai_response) < self.modality_policy.min_confidence:
+                        break
+                    print(f"Next Action: {ai_response.get('next_action')} (confidence {ai_response.get('confidence')}/10, "
+                          f"follow-up and notes still streaming)")
+                    if on_action is not None:
+                        if ("followup",) not in fields:
+                            followup = self._pending_followup = Future()
+                        dispatched = asyncio.ensure_future(on_action(ai_response))
+            except Exception as e:
+                if ai_response is None:
+                    raise
+                print(f"Response stream ended early: {e}")
+            finally:
+                if followup is not None and not followup.done():
+                    # The stream ended without a follow-up: run the action on its own
+                    followup.set_result({})
+            
+            prompt_tokens, response_tokens = self._record_usage(response, estimated_tokens + image_tokens, estimated_tokens,
+                                                                parser.buffer)
+            span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens,
+                     response_bytes=len(parser.buffer.encode('utf-8')))
+        
+        if dispatched is not None:
+            await dispatched
+            self._pending_followup = None
+        if followup is not None:
+            ai_response.update(followup.result())
+        if ai_response is not None:
+            notes = fields.get(("notes",))
+            if not isinstance(notes, dict):
+                notes = {path[1]: value for path, value in fields.items() if len(path) == 2 and path[0] == "notes"}
+            ai_response.update(notes)
+        return parser.buffer, ai_response
+    
+    @staticmethod
+    def _flatten_response(response: Dict) -> Dict:
+        """Turn the action/followup/notes layout of STREAMED_RESPONSE_SCHEMA into the flat response the agent
+        acts on; flat responses are returned unchanged"""
+        if not isinstance(response, dict) or not isinstance(response.get("action"), dict):
+            return response
+        ai_response = dict(response["action"])
+        followup = response.get("followup") if isinstance(response.get("followup"), dict) else {}
+        ai_response["plan"] = followup.get("plan") or []
+        ai_response["alternative_actions"] = followup.get("alternative_actions") or []
+        if isinstance(response.get("notes"), dict):
+            ai_response.update(response["notes"])
+        return ai_response
+    
+    @staticmethod
+    def _parse_response(response_text: str) -> Dict:
+        if "```json" in response_text:
+            json_start = response_text.find("```json") + 7
+            json_end = response_text.find("```", json_start)
+            json_text = response_text[json_start:json_end].strip()
+        else:
+            json_text = response_text
+        return json.loads(json_text)
+    
+    def _observe_page(self) -> Tuple[Dict, List[ElementInfo], str]:
+        """Page info, the current element list and the element section of the prompt"""
+        page_info = self.get_page_info()
+        
+        if self.incremental:
+            delta = self.get_page_elements_delta(force_full=self._force_full_snapshot)
+            self._force_full_snapshot = False
+            elements = list(self._element_cache.values())
+            self._handles = dict(self._element_cache)
+            if delta.full or not self._history:
+                self._history = []
+                elements_section = "AVAILABLE ELEMENTS:\n" + self._format_elements(elements)
+            else:
+                elements_section = self._format_element_delta(delta)
+        else:
+            elements = self.get_page_elements()
+            self._handles = {elem.handle: elem for elem in elements}
+            elements_section = "AVAILABLE ELEMENTS:\n" + self._format_elements(elements)
+        
+        return page_info, elements, elements_section
+    
+    def _format_elements(self, elements: List[ElementInfo]) -> str:
+        if self.prompt_format == "compact":
+            return serialize_elements_compact(elements, self.element_token_budget, self.token_counter)
+        return json.dumps(self._summarize_elements(elements), indent=2)
+    
+    def _summarize_elements(self, elements: List[ElementInfo]) -> List[Dict]:
+        elements_summary = []
+        for elem in elements:
+            elements_summary.append({
+                "id": elem.element_id,
+                "tag": elem.tag,
+                "text": elem.text,
+                "attributes": elem.attributes,
+                "xpath": elem.xpath,
+                "coordinates": elem.coordinates
+            })
+        return elements_summary
+    
+    def _format_element_delta(self, delta: ElementDelta) -> str:
+        """Describe a delta against the element list sent in the earlier messages of this conversation"""
+        if not (delta.added or delta.changed or delta.removed):
+            return "AVAILABLE ELEMENTS: unchanged since the previous step (see the earlier messages)."
+        
+        sections = ["AVAILABLE ELEMENTS: same as the previous step except for the changes below."]
+        if delta.added:
+            sections.append("NEW SINCE LAST STEP:\n" + self._format_elements(delta.added))
+        if delta.changed:
+            sections.append("CHANGED SINCE LAST STEP:\n" + self._format_elements(delta.changed))
+        if delta.removed:
+            if self.prompt_format == "compact":
+                removed = [elem.handle for elem in delta.removed]
+            else:
+                removed = [elem.element_id for elem in delta.removed]
+            sections.append("REMOVED SINCE LAST STEP: " + json.dumps(removed))
+        return "\n".join(sections)
+    
+    def _resolve_target(self, target):
+        """Map a numeric element handle from the model back to its XPath; anything else is returned unchanged"""
+        if isinstance(target, bool):
+            return target
+        if isinstance(target, int) or (isinstance(target, str) and target.strip().isdigit()):
+            elem = self._handles.get(int(target))
+            if elem is not None:
+                return elem.xpath
+        return target
+    
+    def _resolve_target_element(self, item: Dict):
+        """Resolve target_element and keep the handle as target_handle, which tells apart elements sharing an XPath"""
+        target = item["target_element"]
+        item["target_element"] = self._resolve_target(target)
+        if item["target_element"] != target:
+            item["target_handle"] = int(target)
+    
+    def _resolve_handles(self, ai_response: Dict) -> Dict:
+        if "target_element" in ai_response:
+            self._resolve_target_element(ai_response)
+        if isinstance(ai_response.get("alternative_actions"), list):
+            ai_response["alternative_actions"] = [self._resolve_target(alt) for alt in ai_response["alternative_actions"]]
+        for item in ai_response.get("plan") or []:
+            if not isinstance(item, dict):
+                continue
+            if "target_element" in item:
+                self._resolve_target_element(item)
+            precondition = item.get("precondition")
+            if isinstance(precondition, dict) and "element_present" in precondition:
+                precondition["element_present"] = self._resolve_target(precondition["element_present"])
+        return ai_response
+    
+    @traced("execute_action")
     def execute_action(self, action_data: Dict) -> bool:
-        """Execute an action based on AI recommendation"""
+        """Execute an action based on AI recommendation. On success, last_action holds what was actually done."""
         action = action_data.get("next_action")
+        self.last_action = None
+        self.tracer.annotate(action=action)
         
         if action == "click":
             xpath = action_data.get("target_element")
             if xpath:
-                success = self.click_element(xpath)
-                if not success:
-                    alternatives = action_data.get("alternative_actions", [])
-                    for alt in alternatives:
-                        if isinstance(alt, str) and (alt.startswith("//") or alt.startswith("/")):
-                            if self.click_element(alt):
-                                return True
-                return success
+                candidates = [(xpath, action_data.get("target_handle"))]
+                for alt in action_data.get("alternative_actions", []):
+                    if isinstance(alt, str) and (alt.startswith("//") or alt.startswith("/")):
+                        candidates.append((alt, None))
+                for candidate, handle in candidates:
+                    if self.click_element(candidate, handle):
+                        self.last_action = {"next_action": "click", "target_element": candidate}
+                        return True
+                return False
         
         elif action == "type":
             xpath = action_data.get("target_element")
             text = action_data.get("input_text")
+            submit = str(action_data.get("submit", "")).lower() == "true"
             if xpath and text:
-                return self.type_text(xpath, text)
+                if self.type_text(xpath, text, submit, action_data.get("target_handle")):
+                    self._typed_texts.append(text)
+                    self.last_action = {"next_action": "type", "target_element": xpath, "input_text": text, "submit": submit}
+                    return True
+                return False
         
         elif action == "scroll":
             direction = action_data.get("scroll_direction", "down")
-            return self.scroll_page(direction)
+            if self.scroll_page(direction):
+                self.last_action = {"next_action": "scroll", "scroll_direction": direction}
+                return True
+            return False
         
         elif action == "navigate":
             url = action_data.get("target_url")
             if url:
-                return self.navigate_to(url)
+                if self.navigate_to(url):
+                    self.last_action = {"next_action": "navigate", "target_url": url}
+                    return True
+                return False
         
         elif action == "wait":
-            wait_time = action_data.get("wait_time", 2)
-            time.sleep(wait_time)
-            print(f"Waited for {wait_time} seconds")
+            wait_time = wait_seconds(action_data.get("wait_time", DEFAULT_WAIT_S))
+            record = self.wait_for_page_ready("wait", timeout=wait_time)
+            print(f"Waited {record['waited_ms'] / 1000:.2f} of up to {wait_time} seconds")
+            self.last_action = {"next_action": "wait", "wait_time": wait_time}
             return True
         
         return False
     
-    async def perform_task(self, url: str, task: str, max_steps: int = 10):
+    def _target_resolves(self, xpath: str, handle: Optional[int] = None) -> bool:
+        handle = self._registry_handle(xpath, handle)
+        element = self.element_registry.get(handle)
+        if element is not None:
+            try:
+                return element.is_displayed()
+            except selenium_exceptions.StaleElementReferenceException:
+                self.element_registry.discard(handle, stale=True)
+        try:
+            elements = self.driver.find_elements(By.XPATH, xpath)
+            return bool(elements) and elements[0].is_displayed()
+        except Exception:
+            return False
+    
+    def _plan_steps(self, ai_response: Dict) -> List[Dict]:
+        steps = []
+        for item in ai_response.get("plan") or []:
+            if isinstance(item, dict) and item.get("action"):
+                step = {key: value for key, value in item.items() if key != "action"}
+                step["next_action"] = item["action"]
+                steps.append(step)
+        return steps
+    
+    def _precondition_failure(self, step: Dict, previous_url: str, current_url: str) -> Optional[str]:
+        """Why a plan step should not run on the current page, or None if it can"""
+        precondition = step.get("precondition") or {}
+        url_contains = precondition.get("url_contains")
+        if url_contains:
+            if url_contains not in current_url:
+                return f"URL does not contain {url_contains!r}"
+        elif current_url != previous_url:
+            return f"page changed unexpectedly to {current_url}"
+        
+        for xpath, handle in ((precondition.get("element_present"), None), (step.get("target_element"), step.get("target_handle"))):
+            if xpath and not self._target_resolves(xpath, handle):
+                return f"{xpath} is not present"
+        return None
+    
+    def _merge_followup(self, ai_response: Dict):
+        """Wait for the follow-up of a streamed action that was dispatched before it arrived and add it to the response"""
+        pending, self._pending_followup = self._pending_followup, None
+        if pending is not None:
+            ai_response.update(pending.result())
+    
+    @traced("execute_plan")
+    def execute_plan(self, ai_response: Dict) -> Tuple[bool, List[Dict]]:
+        """Run next_action (falling back to the alternatives), then the follow-up plan steps while their
+        preconditions hold. Returns whether next_action succeeded and the actions actually executed."""
+        executed = []
+        url = self.driver.current_url
+        
+        success = self.execute_action(ai_response)
+        self._merge_followup(ai_response)
+        if not success:
+            print("Primary action failed, trying alternatives...")
+            alternatives = ai_response.get("alternative_actions", [])
+            for alt_action in alternatives[:2]:
+                try:
+                    if isinstance(alt_action, str) and (alt_action.startswith("//") or alt_action.startswith("/")):
+                        if self.click_element(alt_action):
+                            self.last_action = {"next_action": "click", "target_element": alt_action}
+                            success = True
+                            break
+                    elif isinstance(alt_action, str):
+                        alt_data = {"next_action": alt_action}
+                        if self.execute_action(alt_data):
+                            success = True
+                            break
+                except Exception as e:
+                    print(f"Alternative action failed: {e}")
+                    continue
+        
+        if not success:
+            return False, executed
+        if self.last_action:
+            executed.append(dict(self.last_action, url=url))
+        
+        plan = self._plan_steps(ai_response)
+        for index, step in enumerate(plan):
+            previous_url, url = url, self.driver.current_url
+            reason = self._precondition_failure(step, previous_url, url)
+            if reason:
+                print(f"Stopping plan at step {index + 2}/{len(plan) + 1}: {reason}")
+                break
+            if not self.execute_action(step):
+                print(f"Plan step {index + 2}/{len(plan) + 1} ({step['next_action']}) failed")
+                break
+            print(f"Plan step {index + 2}/{len(plan) + 1} done: {step['next_action']}")
+            executed.append(dict(self.last_action, url=url))
+        
+        return True, executed
+    
+    @traced("verify_completion")
+    def verify_completion(self, evidence) -> Optional[str]:
+        """Where the model's completion evidence was found (title, url, page text), or None. Evidence shorter
+        than MIN_EVIDENCE_CHARS or taken from text the agent typed itself during the task proves nothing."""
+        if not isinstance(evidence, str) or not evidence.strip():
+            return None
+        normalized = " ".join(evidence.split()).lower()
+        if len(normalized) < MIN_EVIDENCE_CHARS:
+            print(f"Evidence {evidence!r} is too short to prove anything")
+            return None
+        if any(normalized in " ".join(typed.split()).lower() for typed in self._typed_texts):
+            print(f"Evidence {evidence!r} is text the agent typed itself")
+            return None
+        try:
+            return self.driver.execute_script(VERIFY_EVIDENCE_SCRIPT, evidence)
+        except Exception as e:
+            print(f"Error verifying completion evidence: {e}")
+            return None
+    
+    @traced("replay")
+    def replay_trajectory(self, steps: List[Dict]) -> int:
+        """Execute stored steps without the model. Returns how many steps ran before the first divergence:
+        a step recorded on another page (host and path), a target that no longer resolves, or a failed action."""
+        for index, step in enumerate(steps):
+            if step.get("url"):
+                recorded, current = urlparse(step["url"]), urlparse(self.driver.current_url)
+                if (recorded.hostname, recorded.path) != (current.hostname, current.path):
+                    print(f"Replay diverged at step {index + 1}: on {self.driver.current_url}, recorded on {step['url']}")
+                    return index
+            target = step.get("target_element")
+            if target and not self._target_resolves(target):
+                print(f"Replay diverged at step {index + 1}: {target} no longer resolves")
+                return index
+            if not self.execute_action(step):
+                print(f"Replay diverged at step {index + 1}: {step.get('next_action')} failed")
+                return index
+            print(f"Replayed step {index + 1}/{len(steps)}: {step.get('next_action')}")
+        return len(steps)
+    
+    async def _act(self, ai_response: Dict, task: str, monitor: ProgressMonitor, trajectory: List[Dict]) -> Dict:
+        """Verify a "done" answer, skip an action repeated on an unchanged page, or execute the plan.
+        Runs after the whole response in text mode and while the notes are still streaming in streamed mode."""
+        if self._llm_started is not None:
+            first_action_ms = (time.perf_counter() - self._llm_started) * 1000
+            self.response_stats["first_actions"] += 1
+            self.response_stats["first_action_ms"] += first_action_ms
+            self.tracer.annotate(first_action_ms=round(first_action_ms, 1))
+            self._llm_started = None
+        
+        repeats = monitor.propose(self.last_state or "", ai_response)
+        self._record_step(ai_response)
+        
+        if ai_response.get("next_action") == "done":
+            found_in = await self._in_driver(self.verify_completion, ai_response.get("evidence"))
+            if found_in:
+                print(f"Completion verified: {ai_response.get('evidence')!r} found in {found_in}")
+                return {"success": True, "repeats": repeats, "done": True}
+            print(f"Completion rejected: evidence {ai_response.get('evidence')!r} not found on the page")
+            self.tracer.count("completion_rejected")
+            self._notes.append(f"You answered done, but the evidence {ai_response.get('evidence')!r} is not on "
+                               f"the page. Continue the task, or quote text that is actually visible.")
+            return {"success": False, "repeats": repeats, "done": False}
+        
+        if repeats:
+            # The same action on the same page already ran without changing anything: don't repeat
+            # it, tell the model instead and drop any cached decision that led here
+            print(f"Skipping repeated {ai_response.get('next_action')} on an unchanged page ({repeats + 1}x)")
+            self.tracer.count("repeated_actions")
+            self._notes.append(f"{ai_response.get('next_action')} on {ai_response.get('target_element') or 'the page'} "
+                               f"was already tried here and the page did not change. Choose a different action.")
+            if self.decision_cache is not None and self.last_fingerprint:
+                self.decision_cache.invalidate(task, self.last_fingerprint)
+            return {"success": False, "repeats": repeats, "done": False}
+        
+        success, executed = await self._in_driver(self.execute_plan, ai_response)
+        self.metrics["actions_executed"] += len(executed)
+        
+        if not success:
+            print("All actions failed, continuing to next step")
+        trajectory.extend(executed)
+        
+        if self.decision_cache is not None and self.last_fingerprint:
+            if ai_response.get("cached") and not success:
+                self.decision_cache.invalidate(task, self.last_fingerprint)
+            elif success and not ai_response.get("cached") and not ai_response.get("fallback"):
+                self.decision_cache.put(task, self.last_fingerprint, ai_response)
+        return {"success": success, "repeats": repeats, "done": False}
+    
+    @staticmethod
+    def _log_response(ai_response: Dict):
+        print(f"AI Analysis: {ai_response.get('analysis')}")
+        print(f"Next Action: {ai_response.get('next_action')}")
+        print(f"Reasoning: {ai_response.get('reasoning')}")
+        print(f"Confidence: {ai_response.get('confidence')}/10")
+        
+        task_progress = ai_response.get('task_progress', '')
+        if task_progress:
+            print(f"Task Progress: {task_progress}")
+    
+    async def perform_task(self, url: str, task: str, max_steps: int = 10) -> TaskResult:
+        """Run the task until the model declares it done with evidence found on the page, a loop or stall is
+        detected, or max_steps is reached"""
         print(f"Starting task: {task}")
         print(f"Target URL: {url}")
         
-        if not self.navigate_to(url):
+        self._history = []
+        self._notes = []
+        self._typed_texts = []
+        self.readiness_log = []
+        self.navigation_log = []
+        self.modality_stats = self._new_modality_stats()
+        self.response_stats = self._new_response_stats()
+        self.previous_step_failed = False
+        self.current_task = task
+        self.metrics["tasks"] += 1
+        llm_calls_before = self.metrics["llm_calls"]
+        task_start = time.perf_counter()
+        self.tracer.begin_task(f"{self.metrics['tasks']}:{task[:40]}")
+        
+        if not await self._in_driver(self.navigate_to, url):
             print("Failed to navigate to URL")
-            return False
+            self.tracer.finish_task()
+            return TaskResult(success=False, reason="navigation_failed", steps=0, final_url=url)
+        first_step_s = round(time.perf_counter() - task_start, 3)
         
+        trajectory: List[Dict] = []
+        stored = self.trajectory_store.load(url, task) if self.trajectory_store is not None else None
+        stored_steps = stored["steps"] if stored else None
+        if stored_steps:
+            print(f"Replaying stored trajectory ({len(stored_steps)} steps)")
+            replayed = await self._in_driver(self.replay_trajectory, stored_steps)
+            trajectory = stored_steps[:replayed]
+            found_in = None
+            if replayed == len(stored_steps):
+                # Every step ran, but only the stored evidence shows the replay reached the same result
+                found_in = await self._in_driver(self.verify_completion, stored["evidence"])
+                if not found_in:
+                    print(f"Replay finished but its evidence {stored['evidence']!r} is not on the page")
+            if found_in:
+                self.metrics["tasks_completed"] += 1
+                self.metrics["steps"] += replayed
+                self.metrics["completed_steps"] += replayed
+                self.metrics["actions_executed"] += replayed
+                final_url = await self._in_driver(lambda: self.driver.current_url)
+                print(f"\nTask completed by replay in {replayed} steps, evidence found in {found_in}")
+                print(f"Final URL: {final_url}")
+                self.tracer.finish_task()
+                return TaskResult(success=True, reason="replayed", steps=replayed, final_url=final_url,
+                                  evidence=stored["evidence"], wall_time_s=round(time.perf_counter() - task_start, 2),
+                                  first_step_s=first_step_s)
+            print("Falling back to the model for the remaining steps")
+        
+        monitor = ProgressMonitor(self.max_repeats, self.max_consecutive_failures)
+        reason = "max_steps"
+        evidence = None
+        steps_used = len(trajectory)
         previous_url = ""
-        for step in range(max_steps):
-            print(f"\n--- Step {step + 1} ---")
-            
-            current_url = self.driver.current_url
-            if current_url != url and current_url != previous_url:
-                print(f"Page changed from {previous_url} to {current_url}")
-            
-            ai_response = await self.analyze_page_with_ai(task)
-            
-            print(f"AI Analysis: {ai_response['analysis']}")
-            print(f"Next Action: {ai_response['next_action']}")
-            print(f"Reasoning: {ai_response['reasoning']}")
-            print(f"Confidence: {ai_response['confidence']}/10")
-            
-            task_progress = ai_response.get('task_progress', '')
-            if task_progress:
-                print(f"Task Progress: {task_progress}")
-            
-            success = self.execute_action(ai_response)
-            
-            if not success:
-                print("Primary action failed, trying alternatives...")
-                alternatives = ai_response.get("alternative_actions", [])
-                for alt_action in alternatives[:2]:
+        for step in range(len(trajectory), max_steps):
+            with self.tracer.span("step", step=step + 1):
+                print(f"\n--- Step {step + 1} ---")
+                self.metrics["steps"] += 1
+                self.task_progress = step / max_steps
+                steps_used = step + 1
+                
+                if self._performance_log:
+                    # Navigations triggered by clicks are logged too; drop them so the log stays small
+                    await self._in_driver(self._read_performance_log)
+                current_url = await self._in_driver(lambda: self.driver.current_url)
+                if current_url != url and current_url != previous_url:
+                    print(f"Page changed from {previous_url} to {current_url}")
+                previous_url = current_url
+                
+                outcome = None
+                
+                async def act(response: Dict):
+                    # In streamed mode this runs while the reply is still arriving; an exception must become a
+                    # failed step here, or analyze_page_with_ai would turn it into a fallback action on top
+                    nonlocal outcome
                     try:
-                        if isinstance(alt_action, str) and (alt_action.startswith("//") or alt_action.startswith("/")):
-                            if self.click_element(alt_action):
-                                success = True
-                                break
-                        elif isinstance(alt_action, str):
-                            alt_data = {"next_action": alt_action}
-                            if self.execute_action(alt_data):
-                                success = True
-                                break
+                        outcome = await self._act(response, task, monitor, trajectory)
                     except Exception as e:
-                        print(f"Alternative action failed: {e}")
-                        continue
-            
-            if not success:
-                print("All actions failed, continuing to next step")
-            
-            previous_url = current_url
-            
-            time.sleep(2)
+                        print(f"Action failed: {e}")
+                        self.tracer.count("action_errors")
+                        outcome = {"success": False, "repeats": 0, "done": False}
+                
+                ai_response = await self.analyze_page_with_ai(task, on_action=act)
+                if outcome is None:
+                    self._log_response(ai_response)
+                    await act(ai_response)
+                
+                success, repeats = outcome["success"], outcome["repeats"]
+                if outcome["done"]:
+                    evidence = ai_response.get("evidence")
+                    reason = "done"
+                    break
+                
+                monitor.record(success)
+                self.previous_step_failed = not success
+                stop_reason = monitor.stop_reason(repeats)
+                if stop_reason:
+                    print(f"Stopping: {'repeating the same action' if stop_reason == 'loop' else 'too many failed steps'}")
+                    reason = stop_reason
+                    break
+                
+                if not success:
+                    await self._in_driver(self.wait_for_page_ready, "step")
+        
+        final_url = await self._in_driver(lambda: self.driver.current_url)
+        result = TaskResult(
+            success=reason == "done",
+            reason=reason,
+            steps=steps_used,
+            llm_calls=self.metrics["llm_calls"] - llm_calls_before,
+            final_url=final_url,
+            evidence=evidence,
+            wall_time_s=round(time.perf_counter() - task_start, 2),
+            modality=self.modality_summary(),
+            first_step_s=first_step_s
+        )
+        print(f"\nTask {'completed' if result.success else 'not completed'} after {result.steps} steps ({reason})")
+        print(f"Final URL: {final_url}")
+        
+        if result.success:
+            self.metrics["tasks_completed"] += 1
+            self.metrics["completed_steps"] += result.steps
+            self.metrics["completed_llm_calls"] += result.llm_calls
+        print(f"LLM calls this task: {result.llm_calls} "
+              f"({self.llm_calls_per_completed_task():.2f} per completed task overall, "
+              f"{self.steps_per_completed_task():.2f} steps per completed task)")
+        
+        if self.readiness_log:
+            total_wait = sum(record["waited_ms"] for record in self.readiness_log)
+            print(f"Readiness waits: {len(self.readiness_log)}, total {total_wait / 1000:.2f} s")
+        if self.navigation_log:
+            transferred = sum(record.get("transferred_bytes") or 0 for record in self.navigation_log)
+            blocked = sum(record["blocked_requests"] for record in self.navigation_log)
+            print(f"Navigations: {len(self.navigation_log)}, {transferred / 1024 / 1024:.2f} MB transferred, {blocked} requests blocked")
+        print(f"Element registry: {self.element_registry.stats()}")
+        if self.modality == "adaptive":
+            print(f"Modality: {json.dumps(result.modality)}")
+        print(f"Rate limiter: {self.rate_limiter.metrics()}")
+        print(f"Responses: {json.dumps(self.response_summary())}")
+        
+        if self.decision_cache is not None:
+            print(f"Decision cache: {self.decision_cache.stats()}")
+            self.decision_cache.save()
+        
+        if self.trajectory_store is not None and trajectory and result.success:
+            self.trajectory_store.save(url, task, trajectory, evidence)
+            print(f"Saved trajectory of {len(trajectory)} steps")
+        
+        self.tracer.finish_task()
+        return result
+    
+    def llm_calls_per_completed_task(self) -> float:
+        if not self.metrics["tasks_completed"]:
+            return 0.0
+        return self.metrics["completed_llm_calls"] / self.metrics["tasks_completed"]
+    
+    def steps_per_completed_task(self) -> float:
+        if not self.metrics["tasks_completed"]:
+            return 0.0
+        return self.metrics["completed_steps"] / self.metrics["tasks_completed"]
+    
+    def _record_step(self, ai_response: Dict):
+        """Hand the step's screenshot and the chosen action to the recorder; drawing happens on its thread"""
+        screenshot, page_info = self.last_screenshot, self.last_page_info or {}
+        if self.recorder is None or screenshot is None:
+            return
+        action = ai_response.get("next_action")
+        label = f"{action}"
+        if action == "type":
+            label += f" '{ai_response.get('input_text', '')}'"
+        elif action == "scroll":
+            label += f" {ai_response.get('scroll_direction', 'down')}"
+        elif action == "done":
+            label += f": {ai_response.get('evidence', '')}"
         
-        print(f"\nTask completed after {max_steps} steps")
-        print(f"Final URL: {self.driver.current_url}")
-        return True
+        box = None
+        target = ai_response.get("target_element")
+        elem = next((elem for elem in self._handles.values() if elem.xpath == target), None) if target else None
+        if elem is not None and page_info.get("viewport_width") and not self.screenshot_config.region:
+            # Element coordinates are page CSS pixels; the screenshot is the (possibly downscaled) viewport
+            scale = screenshot.width / page_info["viewport_width"]
+            x, y, width, height = elem.coordinates
+            box = ((x - page_info.get("scroll_x", 0)) * scale, (y - page_info.get("scroll_y", 0)) * scale,
+                   width * scale, height * scale)
+        self.recorder.add_frame(screenshot.data, {"box": box, "label": label})
     
     def close(self):
-        if self.driver:
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.decision_cache is not None:
+            self.decision_cache.save()
+        if self.driver and self._owns_driver:
             self.driver.quit()
             print("Browser closed")
+        self._driver_executor.shutdown(wait=False)
 
 async def main():    
     API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -477,16 +3577,22 @@ async def main():
     if not API_KEY:
         raise ValueError("GOOGLE_API_KEY not found in .env file")
     
-    agent = WebNavigationAgent(API_KEY, headless=False)
+    start = time.perf_counter()
+    agent = await WebNavigationAgent.create(API_KEY, headless=False)
+    ready_s = time.perf_counter() - start
     
     try:
-        await agent.perform_task(
+        result = await agent.perform_task(
             url="https://google.com",
             task="Search for 'agentic ai' and click on the first result.",
             max_steps=7
         )
+        print(f"Result: {json.dumps(result.to_dict())}")
+        first_step_s = start - _IMPORT_STARTED + ready_s + (result.first_step_s or 0)
+        print(f"Startup: {json.dumps(dict(startup_timings(), **agent.startup))}, agent ready in {ready_s:.2f} s, "
+              f"first step {first_step_s:.2f} s after the import started")
         
-        time.sleep(5)
+        await asyncio.sleep(5)
         
     except Exception as e:
         print(f"Error during task execution: {e}")